@@ -0,0 +1,269 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks vault-generator.py against synthetic scan data. Everything runs offline in a temp directory.
+# Results are written to a JSON file that can be compared against a previous run with --compare
+
+SIZES = {"1k": 1000, "10k": 10000, "100k": 100000, "1m": 1000000}
+DEFAULT_SIZES = ["1k", "10k"]
+
+# Roughly what an external sweep looks like: web ports dominate, with a long tail of everything else
+PORT_WEIGHTS = [
+    ("80", "http", 40), ("443", "https", 45), ("22", "ssh", 12), ("21", "ftp", 3), ("25", "smtp", 4),
+    ("53", "domain", 2), ("110", "pop3", 1), ("143", "imap", 1), ("445", "microsoft-ds", 1), ("3389", "ms-wbt-server", 2),
+    ("8080", "http-proxy", 8), ("8443", "https-alt", 6), ("3306", "mysql", 1), ("5432", "postgresql", 1),
+    ("993", "imaps", 1), ("995", "pop3s", 1), ("1723", "pptp", 1), ("5900", "vnc", 1), ("9200", "wap-wsp", 1),
+]
+SUBDOMAINS = ["www", "mail", "dev", "vpn", "portal", "api", "test", "staging", "remote", "owa", "shop", "cdn"]
+DOMAINS = ["client.com", "client.net", "client-corp.com", "clientcloud.io"]
+
+SCENARIOS = {
+    "parse-gnmap": ["-g", "{gnmap}"],
+    "parse-gnmap-map": ["-g", "{gnmap}", "-m", "{host_map}"],
+    "parse-host-map": ["-m", "{host_map}"],
+    "parse-host-list": ["-l", "{host_list}"],
+}
+
+
+#                  #
+# Synthetic inputs #
+#                  #
+def get_ip(index):
+    # Spread hosts over 10.0.0.0/8 so they land in many /24s
+    index += 1
+    return "10.{0}.{1}.{2}".format((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+
+def get_ports(rng):
+    # Most hosts have one or two open ports, a few have a lot
+    count = min(int(rng.expovariate(0.7)) + 1, len(PORT_WEIGHTS))
+    weights = [weight for _, _, weight in PORT_WEIGHTS]
+    chosen = []
+    while len(chosen) < count:
+        port = rng.choices(PORT_WEIGHTS, weights)[0]
+        if port not in chosen:
+            chosen.append(port)
+
+    return sorted(chosen, key=lambda port: int(port[0]))
+
+def get_domains(rng, index):
+    # About a third of IPs have no name, shared hosting IPs have several
+    count = rng.choices([0, 1, 2, 3, 8], [35, 45, 12, 6, 2])[0]
+    domain = DOMAINS[index % len(DOMAINS)]
+
+    return ["{0}{1}-{2}.{3}".format(rng.choice(SUBDOMAINS), index, n, domain) for n in range(count)]
+
+def generate_inputs(folder, hosts, seed):
+    """
+    Writes a gnmap, host map and host list for the given number of hosts
+    Returns the paths and the number of bytes generated
+    """
+    rng = random.Random(seed)
+    paths = {"gnmap": os.path.join(folder, "scan.gnmap"), "host_map": os.path.join(folder, "scan.hostmap"),
+             "host_list": os.path.join(folder, "scan.hosts")}
+
+    with open(paths["gnmap"], "w") as gnmap, open(paths["host_map"], "w") as host_map, \
+            open(paths["host_list"], "w") as host_list:
+        gnmap.write("# Nmap 7.94 scan initiated as: nmap -oG scan.gnmap 10.0.0.0/8\n")
+
+        for index in range(hosts):
+            ip = get_ip(index)
+            domains = get_domains(rng, index)
+            rdns = "(" + domains[0] + ")" if len(domains) > 0 and rng.random() < 0.4 else "()"
+            ports = ", ".join("{0}/open/tcp//{1}///".format(port, service) for port, service, _ in get_ports(rng))
+
+            gnmap.write("Host: {0} {1}\tStatus: Up\n".format(ip, rdns))
+            gnmap.write("Host: {0} {1}\tPorts: {2}\tIgnored State: closed (997)\n".format(ip, rdns, ports))
+
+            for domain in domains:
+                host_map.write(domain + "," + ip + "\n")
+                host_list.write("https://" + domain + "/\n")
+
+        gnmap.write("# Nmap done -- {0} IP addresses ({0} hosts up) scanned\n".format(hosts))
+
+    input_bytes = {name: os.path.getsize(path) for name, path in paths.items()}
+
+    return paths, input_bytes
+
+
+#         #
+# Running #
+#         #
+def get_generator_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "vault-generator.py")
+
+def run_measured(command):
+    """
+    Runs a command and returns (wall time, peak RSS in KB, return code)
+    """
+    # stderr goes to a temp file rather than a pipe, a child that fills the pipe would block forever in wait4
+    with tempfile.TemporaryFile() as stderr:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start_time
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if process.returncode != 0:
+            print("[!] Command failed ({0}): {1}".format(process.returncode, " ".join(command)))
+            stderr.seek(0)
+            print(stderr.read().decode(errors="replace"))
+
+    # ru_maxrss is in KB on Linux
+    return wall_time, usage.ru_maxrss, process.returncode
+
+def count_files(path):
+    count = 0
+    for _, _, files in os.walk(path):
+        count += len(files)
+
+    return count
+
+def run_init(work_folder, op_name, op_type):
+    command = [sys.executable, get_generator_path(), "init", "-f", work_folder, "-n", op_name, "-t", op_type, "--vault"]
+    wall_time, peak_rss, returncode = run_measured(command)
+    files = count_files(os.path.join(work_folder, op_name))
+
+    return {"scenario": "init-vault-" + op_type, "wall_time": round(wall_time, 4), "files": files,
+            "files_per_sec": round(files / wall_time, 1) if wall_time > 0 else 0, "peak_rss_kb": peak_rss,
+            "ok": returncode == 0}
+
+def run_parse(work_folder, scenario, size_name, paths, extra_args):
+    op_name = "Bench-" + scenario + "-" + size_name
+    init_command = [sys.executable, get_generator_path(), "init", "-f", work_folder, "-n", op_name, "-t", "external"]
+    subprocess.run(init_command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+
+    op_folder = os.path.join(work_folder, op_name)
+    scenario_args = [arg.format(**paths) for arg in SCENARIOS[scenario]]
+    command = [sys.executable, get_generator_path(), "parse", "-f", op_folder, "-n", op_name, "-t", "external"]
+    wall_time, peak_rss, returncode = run_measured(command + scenario_args + extra_args)
+    files = count_files(os.path.join(op_folder, "Content"))
+
+    # Notes from big runs can fill a temp disk quickly, so don't keep them around
+    shutil.rmtree(op_folder, ignore_errors=True)
+
+    return {"scenario": scenario, "wall_time": round(wall_time, 4), "files": files,
+            "files_per_sec": round(files / wall_time, 1) if wall_time > 0 else 0, "peak_rss_kb": peak_rss,
+            "ok": returncode == 0}
+
+def get_git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(get_generator_path()),
+                                capture_output=True, text=True)
+        return result.stdout.strip()
+    except Exception:
+        return ""
+
+
+#           #
+# Reporting #
+#           #
+def print_result(result):
+    print("  {0:<22} {1:>9} hosts  {2:>9.2f}s  {3:>8} files  {4:>10.1f} files/sec  {5:>8} KB peak".format(
+        result["scenario"], result.get("hosts", "-"), result["wall_time"], result["files"], result["files_per_sec"],
+        result["peak_rss_kb"]))
+
+def compare_results(old_path, results):
+    try:
+        with open(old_path, "r") as f:
+            old = json.load(f)
+    except Exception as e:
+        print("[!] Error reading results to compare against: {0}".format(e))
+        return
+
+    old_results = {(r["scenario"], r.get("hosts")): r for r in old["results"]}
+
+    print("\n[+] Compared to {0} ({1})".format(old_path, old["meta"].get("commit", "")))
+    for result in results:
+        previous = old_results.get((result["scenario"], result.get("hosts")))
+        if previous is None:
+            continue
+
+        time_change = (result["wall_time"] - previous["wall_time"]) / previous["wall_time"] * 100 \
+            if previous["wall_time"] > 0 else 0
+        rss_change = (result["peak_rss_kb"] - previous["peak_rss_kb"]) / previous["peak_rss_kb"] * 100 \
+            if previous["peak_rss_kb"] > 0 else 0
+        print("  {0:<22} {1:>9} hosts  time {2:+7.1f}%  peak RSS {3:+7.1f}%".format(
+            result["scenario"], result.get("hosts", "-"), time_change, rss_change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vault-generator.py init and parse against synthetic scans.")
+    parser.add_argument("-s", "--sizes", default=",".join(DEFAULT_SIZES), help="Comma separated host counts to run: "
+                        + ", ".join(SIZES) + " (default: " + ",".join(DEFAULT_SIZES) + ")")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated parse scenarios to run "
+                        + "(default: all): " + ", ".join(SCENARIOS))
+    parser.add_argument("-o", "--output", default="bench-results.json", help="Path to write the JSON results to "
+                        + "(default: bench-results.json)")
+    parser.add_argument("-c", "--compare", help="Path to an earlier results file to compare against")
+    parser.add_argument("--seed", type=int, default=1337, help="Seed for the synthetic data (default: 1337)")
+    parser.add_argument("--work-dir", help="Folder to create the temp vaults in (default: system temp folder)")
+    parser.add_argument("--parse-args", default="", help="Extra arguments passed to every parse run, e.g. \"-w 16\"")
+
+    args = parser.parse_args()
+
+    size_names = [size.strip().lower() for size in args.sizes.split(",") if size.strip() != ""]
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip() != ""]
+    for size_name in size_names:
+        if size_name not in SIZES:
+            print("Error: Unknown size {0}. Use one or more of: {1}".format(size_name, ", ".join(SIZES)))
+            sys.exit(1)
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            print("Error: Unknown scenario {0}. Use one or more of: {1}".format(scenario, ", ".join(SCENARIOS)))
+            sys.exit(1)
+
+    results = []
+    work_folder = tempfile.mkdtemp(prefix="vault-bench-", dir=args.work_dir)
+
+    try:
+        print("[*] Working in {0}".format(work_folder))
+
+        print("\n[*] init --vault")
+        for op_type in ["internal", "external"]:
+            result = run_init(work_folder, "BenchVault-" + op_type, op_type)
+            results.append(result)
+            print_result(result)
+
+        for size_name in size_names:
+            hosts = SIZES[size_name]
+            input_folder = os.path.join(work_folder, "input-" + size_name)
+            os.mkdir(input_folder)
+
+            print("\n[*] Generating {0} hosts".format(hosts))
+            paths, input_bytes = generate_inputs(input_folder, hosts, args.seed)
+
+            for scenario in scenarios:
+                result = run_parse(work_folder, scenario, size_name, paths, args.parse_args.split())
+                result["hosts"] = hosts
+                result["input_bytes"] = input_bytes
+                results.append(result)
+                print_result(result)
+
+            shutil.rmtree(input_folder, ignore_errors=True)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    output = {"meta": {"commit": get_git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "seed": args.seed, "parse_args": args.parse_args,
+                       "timestamp": datetime.datetime.now().isoformat(timespec="seconds")},
+              "results": results}
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("\n[+] Results written to {0}".format(args.output))
+
+    if args.compare is not None:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
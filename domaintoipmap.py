@@ -1,12 +1,48 @@
 import argparse
+import bz2
+import concurrent.futures
+import cProfile
+import gzip
+import json
+import lzma
+import os
+import random
 import socket
+import sqlite3
+import struct
+import threading
+import time
 
 
+# DNS record types supported by the resolvers
+RECORD_TYPES = {"A": 1, "AAAA": 28}
+
+# Input files compressed with gzip, xz or bzip2 are detected by their first bytes and decompressed as they're read
+COMPRESSION_OPENERS = [(b"\x1f\x8b", gzip.open), (b"\xfd7zXZ\x00", lzma.open), (b"BZh", bz2.open)]
+
+# Answers are cached here between runs (see ResolutionCache). Names that resolved are reused for the lowest TTL
+# of their records, or CACHE_TTL seconds if the resolver can't tell (the system resolver doesn't report TTLs).
+# Names that didn't resolve are reused for NEGATIVE_CACHE_TTL. Lookups that timed out or hit an error are never cached
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "domaintoipmap.sqlite")
+CACHE_TTL = 86400
+NEGATIVE_CACHE_TTL = 3600
+
+
+def open_input(filename):
+	with open(filename, "rb") as f:
+		magic = f.read(6)
+
+	for prefix, opener in COMPRESSION_OPENERS:
+		if magic.startswith(prefix):
+			return opener(filename, "rt")
+
+	return open(filename)
+
 def read_file(filename):
 	hosts = []
 	try:
-		with open(filename) as f:
-			hosts = f.readlines()
+		with open_input(filename) as f:
+			hosts = [line.strip() for line in f if line.strip() != ""]
 	except Exception as e:
 		print("Error reading input file: {0}".format(e))
 
@@ -16,36 +52,341 @@ def write_output(map, output_file, ip_file):
 	try:
 		with open(output_file, 'w') as m, open(ip_file, 'w') as i:
 			for item in map:
-				m.write(item["host"] + "," + item["ip"] + "\n")
-				if item["ip"] != "":
-					i.write(item["ip"] + "\n")
-	except Execption as e:
+				if len(item["ips"]) == 0:
+					m.write(item["host"] + ",\n")
+					continue
+
+				for ip in item["ips"]:
+					m.write(item["host"] + "," + ip + "\n")
+					i.write(ip + "\n")
+	except Exception as e:
 		print("Error writing output: {0}".format(e))
 
 
-def fetch_ips(hosts):
-	mapping = []
+#                  #
+# Resolver backends #
+#                  #
+# A backend only needs a resolve(host, record_types, timeout) method that returns (addresses, ttl), with
+# an empty list if the name doesn't exist and ttl the lowest record TTL in seconds or None if it isn't known,
+# and raises socket.timeout if the lookup takes too long
+
+class SystemResolver:
+	"""
+	Uses the operating system's resolver (getaddrinfo). getaddrinfo can't be given a timeout,
+	so the lookup runs in a daemon thread that is abandoned if it doesn't finish in time.
+	It doesn't return record TTLs either, so answers are cached for --cache-ttl
+	"""
+	FAMILIES = {"A": socket.AF_INET, "AAAA": socket.AF_INET6}
+
+	def resolve(self, host, record_types, timeout):
+		result = {}
+
+		def lookup():
+			try:
+				result["ips"] = self._getaddrinfo(host, record_types)
+			except socket.gaierror:
+				result["ips"] = []
+			except Exception as e:
+				result["error"] = e
+
+		thread = threading.Thread(target=lookup, daemon=True)
+		thread.start()
+		thread.join(timeout)
+
+		if thread.is_alive():
+			raise socket.timeout("Lookup for {0} timed out".format(host))
+		if "error" in result:
+			raise result["error"]
+
+		return result["ips"], None
+
+	def _getaddrinfo(self, host, record_types):
+		ips = []
+		for record_type in record_types:
+			try:
+				answers = socket.getaddrinfo(host, None, self.FAMILIES[record_type], socket.SOCK_STREAM)
+			except socket.gaierror:
+				continue
+
+			for answer in answers:
+				ip = answer[4][0]
+				if ip not in ips:
+					ips.append(ip)
+
+		return ips
+
+
+class DnsResolver:
+	"""
+	Sends queries straight to a nameserver over UDP. Honors the timeout natively, and can be
+	pointed at a local stub server (e.g. 127.0.0.1:5353) to test without network access
+	"""
+	def __init__(self, nameserver, port=53):
+		self.nameserver = nameserver
+		self.port = port
+
+	def resolve(self, host, record_types, timeout):
+		ips = []
+		ttls = []
+		for record_type in record_types:
+			answers, ttl = self._query(host, RECORD_TYPES[record_type], timeout)
+			for ip in answers:
+				if ip not in ips:
+					ips.append(ip)
+			if ttl is not None:
+				ttls.append(ttl)
+
+		return ips, min(ttls) if len(ttls) > 0 else None
+
+	def _query(self, host, qtype, timeout):
+		query_id = random.randint(0, 0xFFFF)
+		packet = build_query(query_id, host, qtype)
+
+		family = socket.AF_INET6 if ":" in self.nameserver else socket.AF_INET
+		with socket.socket(family, socket.SOCK_DGRAM) as s:
+			s.settimeout(timeout)
+			s.sendto(packet, (self.nameserver, self.port))
+			while True:
+				response, _ = s.recvfrom(4096)
+				if len(response) >= 2 and struct.unpack(">H", response[:2])[0] == query_id:
+					break
+
+		return parse_response(response, qtype)
+
+
+def build_query(query_id, host, qtype):
+	# Header: id, flags (recursion desired), 1 question, 0 answers/authority/additional
+	header = struct.pack(">HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+	question = b""
+	for label in host.rstrip(".").split("."):
+		encoded = label.encode("idna")
+		question += bytes([len(encoded)]) + encoded
+	question += b"\x00" + struct.pack(">HH", qtype, 1)
+
+	return header + question
+
+def skip_name(data, offset):
+	# Walks past a (possibly compressed) domain name and returns the offset after it
+	while True:
+		length = data[offset]
+		if length == 0:
+			return offset + 1
+		if length & 0xC0 == 0xC0:
+			return offset + 2
+		offset += length + 1
+
+def parse_response(data, qtype):
+	"""
+	Returns (addresses, ttl) from a response, where ttl is the lowest TTL of the answer
+	records (CNAMEs included) or None if there were none
+	"""
+	ips = []
+	ttl = None
+	_, flags, qdcount, ancount, _, _ = struct.unpack(">HHHHHH", data[:12])
+
+	# NXDOMAIN and other errors just mean no addresses
+	if flags & 0x000F != 0:
+		return ips, ttl
+
+	offset = 12
+	for _ in range(qdcount):
+		offset = skip_name(data, offset) + 4
+
+	for _ in range(ancount):
+		offset = skip_name(data, offset)
+		rtype, _, record_ttl, rdlength = struct.unpack(">HHIH", data[offset:offset + 10])
+		offset += 10
+		rdata = data[offset:offset + rdlength]
+		offset += rdlength
+		ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+
+		if rtype != qtype:
+			continue
+		if rtype == RECORD_TYPES["A"]:
+			ips.append(socket.inet_ntop(socket.AF_INET, rdata))
+		elif rtype == RECORD_TYPES["AAAA"]:
+			ips.append(socket.inet_ntop(socket.AF_INET6, rdata))
+
+	return ips, ttl
+
 
-	for host in hosts:	
-		host = host.rstrip()
-		print("Resolving host: {0}".format(host), end="... ")
+#                  #
+# Resolution cache #
+#                  #
+
+class ResolutionCache:
+	"""
+	SQLite cache of lookup answers keyed by host and record types, so reruns against the same
+	scope only look up names that are new or whose answer has expired. Every address returned is
+	stored, so a cached answer can be written with or without --all
+	"""
+	def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, negative_ttl=NEGATIVE_CACHE_TTL, refresh=False):
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		self.conn = sqlite3.connect(path)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS lookups (host TEXT NOT NULL, record_types TEXT NOT NULL, "
+			+ "ips TEXT NOT NULL, resolved_at REAL NOT NULL, ttl REAL NOT NULL, PRIMARY KEY (host, record_types))")
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.refresh = refresh
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, host, record_types):
+		"""
+		Returns the cached addresses for a host, or None if it has to be looked up
+		"""
+		row = None
+		if not self.refresh:
+			row = self.conn.execute("SELECT ips, resolved_at, ttl FROM lookups WHERE host = ? AND record_types = ?",
+				(host.lower(), ",".join(record_types))).fetchone()
+
+		if row is None or row[1] + row[2] < time.time():
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return json.loads(row[0])
+
+	def put(self, host, record_types, ips, ttl=None):
+		"""
+		Caches an answer for the record TTL, or the default TTL if the resolver didn't return one
+		"""
+		if len(ips) == 0:
+			ttl = self.negative_ttl
+		elif ttl is None:
+			ttl = self.ttl
+		self.conn.execute("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)",
+			(host.lower(), ",".join(record_types), json.dumps(ips), time.time(), ttl))
+
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
+
+
+#                 #
+# Resolver engine #
+#                 #
+
+def resolve_host(resolver, host, record_types, timeout, retries):
+	"""
+	Resolves a single host, retrying on timeouts
+	Returns (ips, ttl, timed_out, error), where error is the exception if the lookup failed any other way
+	"""
+	for attempt in range(retries + 1):
 		try:
-			s = socket.gethostbyname(host)
-			mapping.append({"host": host, "ip": s})
-			print(s)
-		except:
-			mapping.append({"host": host, "ip": ""})
-			print("failed")
+			ips, ttl = resolver.resolve(host, record_types, timeout)
+			return ips, ttl, False, None
+		except socket.timeout:
 			continue
+		except Exception as e:
+			return [], None, False, e
+
+	return [], None, True, None
+
+def fetch_ips(hosts, resolver=None, concurrency=50, timeout=3.0, retries=1, record_types=("A",), all_records=False,
+		stats=None, cache=None):
+	"""
+	Resolves the hosts concurrently. The mapping keeps the order of the input list regardless
+	of which lookups finish first. Only the first address is kept unless all_records is set
+	If a stats dict is supplied, the resolved/failed/timeout counts are added to it
+	If a ResolutionCache is supplied, cached answers are used and new answers are added to it
+	"""
+	if resolver is None:
+		resolver = SystemResolver()
+	if stats is None:
+		stats = {}
+	for counter in ["resolved", "failed", "timeouts"]:
+		stats.setdefault(counter, 0)
+
+	mapping = [None] * len(hosts)
+
+	def add_result(index, host, ips, timed_out, cached=False, error=None):
+		if not all_records:
+			ips = ips[:1]
+
+		mapping[index] = {"host": host, "ips": ips}
+		source = " (cached)" if cached else ""
+
+		if len(ips) > 0:
+			stats["resolved"] += 1
+			print("Resolved host: {0}... {1}{2}".format(host, ", ".join(ips), source))
+		elif timed_out:
+			stats["timeouts"] += 1
+			print("Resolved host: {0}... timed out".format(host))
+		elif error is not None:
+			stats["failed"] += 1
+			print("Resolved host: {0}... failed ({1})".format(host, error))
+		else:
+			stats["failed"] += 1
+			print("Resolved host: {0}... failed{1}".format(host, source))
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+		futures = {}
+		for index, host in enumerate(hosts):
+			host = host.rstrip()
+
+			cached_ips = cache.get(host, record_types) if cache is not None else None
+			if cached_ips is not None:
+				add_result(index, host, cached_ips, False, True)
+				continue
+
+			future = executor.submit(resolve_host, resolver, host, record_types, timeout, retries)
+			futures[future] = (index, host)
+
+		for future in concurrent.futures.as_completed(futures):
+			index, host = futures[future]
+			ips, ttl, timed_out, error = future.result()
+
+			# A timeout or error says nothing about the name, so it is looked up again next time
+			if cache is not None and not timed_out and error is None:
+				cache.put(host, record_types, ips, ttl)
+
+			add_result(index, host, ips, timed_out, error=error)
 
 	return mapping
 
+def get_resolver(nameserver):
+	if nameserver is None:
+		return SystemResolver()
+
+	# Accept ip, ip:port, or [ipv6]:port
+	port = 53
+	if nameserver.startswith("["):
+		address, _, port_str = nameserver[1:].partition("]:")
+		nameserver = address.rstrip("]")
+		if port_str:
+			port = int(port_str)
+	elif nameserver.count(":") == 1:
+		nameserver, port_str = nameserver.split(":")
+		port = int(port_str)
+
+	return DnsResolver(nameserver, port)
+
 
 def main():
 	parser = argparse.ArgumentParser(prog="Parse hosts for ips", description="Output two files, one with hosts and IPs and one with just IPs")
 	parser.add_argument('-i', '--input', help="Full path to the input file")
 	parser.add_argument('-oM', '--map', help="Full path to the output file for subdomains")
 	parser.add_argument('-oI', '--ips', help="Full path to the output file for IPs")
+	parser.add_argument('-c', '--concurrency', type=int, default=50, help="Number of lookups to run at once (default: 50)")
+	parser.add_argument('--timeout', type=float, default=3.0, help="Seconds to wait for each lookup (default: 3)")
+	parser.add_argument('--retries', type=int, default=1, help="Times to retry a lookup that timed out (default: 1)")
+	parser.add_argument('-r', '--record-types', default="A", help="Comma separated record types to look up: A, AAAA "
+		+ "or A,AAAA (default: A)")
+	parser.add_argument('--all', action="store_true", help="Write every address returned for a host instead of only the first")
+	parser.add_argument('--stats', action="store_true", help="Print timings, lookups/sec and timeout counts as JSON when finished")
+	parser.add_argument('--profile', metavar="PATH", help="Write a cProfile/pstats profile of the run to PATH")
+	parser.add_argument('--nameserver', help="Query this nameserver directly (ip or ip:port) instead of using the "
+		+ "system resolver. Useful for pointing at a local stub DNS server")
+	parser.add_argument('--cache', default=CACHE_PATH, help="Path to the lookup cache shared between runs "
+		+ "(default: .cache/domaintoipmap.sqlite next to this script)")
+	parser.add_argument('--no-cache', action="store_true", help="Look up every host and don't read or update the cache")
+	parser.add_argument('--refresh', action="store_true", help="Look up every host again and update the cache with "
+		+ "the new answers")
+	parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL, help="Seconds a cached answer is reused for "
+		+ "when the resolver doesn't return record TTLs, as with the system resolver (default: {0})".format(CACHE_TTL))
+	parser.add_argument('--negative-ttl', type=float, default=NEGATIVE_CACHE_TTL, help="Seconds a cached failed "
+		+ "lookup is reused for (default: {0})".format(NEGATIVE_CACHE_TTL))
 
 	args = parser.parse_args()
 
@@ -53,9 +394,62 @@ def main():
 		print("Please supply the required arguments: -i INPUT.txt -oM OUTPUT_MAP.txt -oI OUTPUT_IP.txt")
 		exit()
 
+	record_types = [r.strip().upper() for r in args.record_types.split(",") if r.strip() != ""]
+	for record_type in record_types:
+		if record_type not in RECORD_TYPES:
+			print("Unsupported record type: {0}. Use A and/or AAAA".format(record_type))
+			exit()
+
+	resolver = get_resolver(args.nameserver)
+
+	cache = None
+	if not args.no_cache:
+		try:
+			cache = ResolutionCache(args.cache, args.cache_ttl, args.negative_ttl, args.refresh)
+		except Exception as e:
+			print("Error opening the lookup cache, looking up every host: {0}".format(e))
+
+	profiler = None
+	if args.profile is not None:
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	stats = {}
+	phases = {}
+	start_time = time.perf_counter()
+
 	hosts = read_file(args.input)
-	mapping = fetch_ips(hosts)
+	phases["read"] = time.perf_counter() - start_time
+
+	try:
+		mapping = fetch_ips(hosts, resolver, max(args.concurrency, 1), args.timeout, max(args.retries, 0),
+			record_types, args.all, stats, cache)
+	finally:
+		if cache is not None:
+			cache.close()
+	phases["resolve"] = time.perf_counter() - start_time - phases["read"]
+
+	if cache is not None:
+		stats["cache_hits"] = cache.hits
+		stats["cache_misses"] = cache.misses
+		hit_rate = round(100 * cache.hits / len(hosts), 1) if len(hosts) > 0 else 0
+		print("Cache: {0} of {1} hosts answered from the cache ({2}%), {3} looked up".format(cache.hits, len(hosts),
+			hit_rate, cache.misses))
+
 	write_output(mapping, args.map, args.ips)
+	phases["write"] = time.perf_counter() - start_time - phases["read"] - phases["resolve"]
+
+	if profiler is not None:
+		profiler.disable()
+		profiler.dump_stats(args.profile)
+		print("[+] Profile written to {0}. View it with: python -m pstats {0}".format(args.profile))
+
+	if args.stats:
+		total_time = time.perf_counter() - start_time
+		stats["lookups"] = len(hosts)
+		stats["lookups_per_sec"] = round(len(hosts) / phases["resolve"], 1) if phases["resolve"] > 0 else 0
+		print(json.dumps({"command": "domaintoipmap", "total_seconds": round(total_time, 4),
+			"phases": {name: round(seconds, 4) for name, seconds in phases.items()}, "counters": stats}, indent=2))
 
 
 if __name__ == '__main__':
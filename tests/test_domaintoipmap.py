@@ -0,0 +1,141 @@
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import domaintoipmap
+
+
+class StubDnsServer:
+	"""
+	Answers A/AAAA queries over UDP on a free local port from a {name:{qtype:[addresses]}} dict.
+	Names that aren't in it get NXDOMAIN, and names in silent are never answered
+	"""
+	def __init__(self, records, ttl=60, silent=()):
+		self.records = records
+		self.ttl = ttl
+		self.silent = silent
+		self.queries = {}
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.bind(("127.0.0.1", 0))
+		self.port = self.socket.getsockname()[1]
+		self.thread = threading.Thread(target=self._serve, daemon=True)
+		self.thread.start()
+
+	def close(self):
+		self.socket.close()
+
+	def _serve(self):
+		while True:
+			try:
+				data, address = self.socket.recvfrom(512)
+			except OSError:
+				return
+
+			offset = 12
+			labels = []
+			while data[offset] != 0:
+				labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+				offset += data[offset] + 1
+			name = ".".join(labels)
+			qtype = struct.unpack(">H", data[offset + 1:offset + 3])[0]
+			question = data[12:offset + 5]
+			self.queries[name] = self.queries.get(name, 0) + 1
+
+			if name in self.silent:
+				continue
+
+			answers = self.records.get(name, {}).get(qtype, [])
+			rcode = 0 if name in self.records else 3
+			body = b""
+			for ip in answers:
+				rdata = socket.inet_pton(socket.AF_INET if qtype == 1 else socket.AF_INET6, ip)
+				body += b"\xc0\x0c" + struct.pack(">HHIH", qtype, 1, self.ttl, len(rdata)) + rdata
+
+			header = data[:2] + struct.pack(">HHHHH", 0x8180 | rcode, 1, len(answers), 0, 0)
+			self.socket.sendto(header + question + body, address)
+
+
+RECORDS = {"a.test": {1: ["10.0.0.1", "10.0.0.2"], 28: ["fe80::1"]}, "b.test": {1: ["10.0.0.3"]}}
+
+
+class TestDnsResolver(unittest.TestCase):
+	def setUp(self):
+		self.server = StubDnsServer(RECORDS, silent=["slow.test"])
+		self.resolver = domaintoipmap.DnsResolver("127.0.0.1", self.server.port)
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.cache_path = os.path.join(self.temp_dir.name, "cache.sqlite")
+
+	def tearDown(self):
+		self.server.close()
+		self.temp_dir.cleanup()
+
+	def fetch(self, hosts, cache=None, **kwargs):
+		stats = {}
+		mapping = domaintoipmap.fetch_ips(hosts, self.resolver, concurrency=4, timeout=0.2, retries=1,
+			stats=stats, cache=cache, **kwargs)
+
+		return mapping, stats
+
+	def test_input_order(self):
+		hosts = ["b.test", "slow.test", "a.test", "nope.test"]
+		mapping, stats = self.fetch(hosts, record_types=("A", "AAAA"), all_records=True)
+
+		self.assertEqual([entry["host"] for entry in mapping], hosts)
+		self.assertEqual([entry["ips"] for entry in mapping],
+			[["10.0.0.3"], [], ["10.0.0.1", "10.0.0.2", "fe80::1"], []])
+
+	def test_first_address_only(self):
+		mapping, stats = self.fetch(["a.test"])
+
+		self.assertEqual(mapping[0]["ips"], ["10.0.0.1"])
+
+	def test_timeout_is_retried(self):
+		mapping, stats = self.fetch(["slow.test"])
+
+		self.assertEqual(self.server.queries["slow.test"], 2)
+		self.assertEqual(stats["timeouts"], 1)
+		self.assertEqual(stats["failed"], 0)
+
+	def test_nxdomain(self):
+		mapping, stats = self.fetch(["nope.test"])
+
+		self.assertEqual(mapping[0]["ips"], [])
+		self.assertEqual(self.server.queries["nope.test"], 1)
+		self.assertEqual(stats["failed"], 1)
+		self.assertEqual(stats["timeouts"], 0)
+
+	def test_answers_are_cached_for_record_ttl(self):
+		cache = domaintoipmap.ResolutionCache(self.cache_path)
+		self.fetch(["a.test", "nope.test", "slow.test"], cache)
+		cache.close()
+
+		cache = domaintoipmap.ResolutionCache(self.cache_path)
+		ttls = dict(cache.conn.execute("SELECT host, ttl FROM lookups"))
+		self.assertEqual(ttls, {"a.test": 60, "nope.test": domaintoipmap.NEGATIVE_CACHE_TTL})
+
+		# Only the timed out lookup is sent again
+		mapping, stats = self.fetch(["a.test", "nope.test", "slow.test"], cache)
+		cache.close()
+		self.assertEqual(mapping[0]["ips"], ["10.0.0.1"])
+		self.assertEqual(self.server.queries, {"a.test": 1, "nope.test": 1, "slow.test": 4})
+		self.assertEqual(cache.hits, 2)
+
+	def test_expired_answers_are_looked_up_again(self):
+		self.server.ttl = 0
+		cache = domaintoipmap.ResolutionCache(self.cache_path)
+		self.fetch(["b.test"], cache)
+		self.fetch(["b.test"], cache)
+		cache.close()
+
+		self.assertEqual(self.server.queries["b.test"], 2)
+		self.assertEqual(cache.hits, 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,160 @@
+import gzip
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vault-generator.py")
+
+GNMAP = """# Nmap 7.94 scan initiated as: nmap -oG s.gnmap 10.0.0.0/24
+Host: 10.0.0.1 ()\tPorts: 80/open/tcp//http///
+Host: 10.0.0.2 ()\tPorts: 443/open/tcp//https///, 8443/open/tcp//https-alt///
+"""
+
+NMAP_XML = """<?xml version="1.0"?>
+<nmaprun>
+<host><status state="up"/><address addr="10.0.0.1" addrtype="ipv4"/>
+<hostnames><hostname name="a.client.com" type="PTR"/></hostnames>
+<ports><port protocol="tcp" portid="22"><state state="open"/><service name="ssh"/></port></ports></host>
+<host><status state="up"/><address addr="10.0.0.2" addrtype="ipv4"/><hostnames/>
+<ports><port protocol="tcp" portid="21"><state state="open"/><service name="ftp"/></port></ports></host>
+</nmaprun>
+"""
+
+MASSCAN = """#masscan
+open tcp 3389 10.0.0.2 1700000000
+open tcp 80 10.0.0.3 1700000000
+open tcp 443 10.0.0.2 1700000000
+# end
+"""
+
+
+def run(*args):
+    return subprocess.run([sys.executable, SCRIPT] + list(args), capture_output=True, text=True, check=True).stdout
+
+def get_counter(output, name):
+    """
+    Returns a counter from the --stats JSON in parse's output, or 0 if it wasn't counted
+    """
+    match = re.search(r'"{0}": (\d+)'.format(name), output)
+
+    return int(match.group(1)) if match is not None else 0
+
+def read_list(path, field):
+    """
+    Returns the items of a list field in a note's frontmatter
+    """
+    items = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line == field + ":":
+                items = []
+            elif items is not None and line.startswith("  - "):
+                items.append(line[4:].strip('"'))
+            elif items is not None:
+                break
+
+    return items
+
+
+class ParseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = self.temp_dir.name
+        self.folder = os.path.join(self.path, "Op")
+        self.content = os.path.join(self.folder, "Content")
+        run("init", "-f", self.path, "-n", "Op", "-t", "external")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_input(self, name, text):
+        path = os.path.join(self.path, name)
+        with open(path, "w") as f:
+            f.write(text)
+
+        return path
+
+    def parse(self, *args):
+        return run("parse", "-f", self.folder, "-n", "Op", "-t", "external", *args)
+
+
+class TestCombinedInputs(ParseTestCase):
+    def test_gnmap_and_xml_ports_are_merged(self):
+        self.parse("-g", self.write_input("s.gnmap", GNMAP), "-x", self.write_input("o.xml", NMAP_XML))
+
+        # The XML's reverse DNS name doesn't give 10.0.0.1 a second note
+        self.assertEqual(sorted(os.listdir(self.content)), ["10.0.0.1 ().md", "10.0.0.2 ().md"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.1 ().md"), "openPorts"), ["80", "22"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "openPorts"), ["443", "8443", "21"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "services"),
+                         ["https", "https-alt", "ftp"])
+
+    def test_gnmap_and_masscan_ports_are_merged(self):
+        self.parse("-g", self.write_input("s.gnmap", GNMAP), "--masscan", self.write_input("m.txt", MASSCAN))
+
+        self.assertEqual(sorted(os.listdir(self.content)), ["10.0.0.1 ().md", "10.0.0.2 ().md", "10.0.0.3 ().md"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "openPorts"), ["443", "8443", "3389"])
+
+    def test_masscan_batches_are_merged(self):
+        self.parse("--masscan", self.write_input("m.txt", MASSCAN), "--batch-size", "1")
+
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "openPorts"), ["3389", "443"])
+
+
+class TestGnmapFolders(ParseTestCase):
+    def test_compressed_gnmap_files_in_folder(self):
+        scans = os.path.join(self.path, "scans")
+        os.mkdir(scans)
+        with gzip.open(os.path.join(scans, "a.gnmap.gz"), "wt") as f:
+            f.write(GNMAP)
+        with gzip.open(os.path.join(scans, "b.GNMAP.gz"), "wt") as f:
+            f.write("Host: 10.0.0.2 ()\tPorts: 21/open/tcp//ftp///\n")
+        with open(os.path.join(scans, "notes.txt.gz"), "wb") as f:
+            f.write(gzip.compress(b"not a scan"))
+
+        self.parse("-g", scans)
+
+        self.assertEqual(sorted(os.listdir(self.content)), ["10.0.0.1 ().md", "10.0.0.2 ().md"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "openPorts"), ["443", "8443", "21"])
+
+
+class TestAliases(ParseTestCase):
+    def test_no_aliases_field_without_aliases(self):
+        self.parse("-g", self.write_input("s.gnmap", GNMAP))
+
+        self.assertIsNone(read_list(os.path.join(self.content, "10.0.0.1 ().md"), "aliases"))
+
+    def test_aliases_field_with_aliases(self):
+        host_map_path = self.write_input("map.csv", "www.client.com,10.0.0.2\n")
+        self.parse("-g", self.write_input("s.gnmap", GNMAP), "-m", host_map_path, "--aliases")
+
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.1 ().md"), "aliases"), [])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "aliases"), ["www.client.com"])
+
+
+class TestIncremental(ParseTestCase):
+    REPEATED = GNMAP + "Host: 10.0.0.2 ()\tPorts: 21/open/tcp//ftp///\n"
+
+    def test_repeated_hosts_are_unchanged_on_rerun(self):
+        gnmap_path = self.write_input("s.gnmap", self.REPEATED)
+        self.parse("-g", gnmap_path)
+
+        output = self.parse("-g", gnmap_path, "--incremental", "--stats")
+        self.assertEqual(get_counter(output, "notes_unchanged"), 2)
+        self.assertEqual(get_counter(output, "notes_written"), 0)
+
+    def test_changed_repeat_is_merged_on_rerun(self):
+        self.parse("-g", self.write_input("s.gnmap", self.REPEATED))
+        changed = self.REPEATED + "Host: 10.0.0.2 ()\tPorts: 25/open/tcp//smtp///\n"
+        self.parse("-g", self.write_input("s2.gnmap", changed), "--incremental")
+
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "openPorts"),
+                         ["443", "8443", "21", "25"])
+
+
+if __name__ == "__main__":
+    unittest.main()
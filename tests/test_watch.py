@@ -0,0 +1,62 @@
+import os
+import unittest
+
+from test_parse import ParseTestCase, read_list, run
+
+XML_HEADER = """<?xml version="1.0"?>
+<nmaprun scanner="nmap" args="nmap -oX scan.xml 10.0.1.0/24">
+"""
+
+XML_HOST = """<host><status state="up"/><address addr="{0}" addrtype="ipv4"/><hostnames/>
+<ports><port protocol="tcp" portid="{1}"><state state="open"/><service name="{2}"/></port></ports></host>
+"""
+
+
+class TestWatch(ParseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scans = os.path.join(self.path, "scans")
+        os.mkdir(self.scans)
+
+    def append(self, name, text):
+        with open(os.path.join(self.scans, name), "a") as f:
+            f.write(text)
+
+    def watch(self):
+        run("watch", "-f", self.folder, "-n", "Op", "-t", "external", "--once", self.scans)
+
+        return sorted(os.listdir(self.content))
+
+    def test_appended_scans_are_picked_up(self):
+        self.append("a.gnmap", "Host: 10.0.0.1 ()\tPorts: 80/open/tcp//http///\nHost: 10.0.0.2 ()\tPorts: 4")
+        self.assertEqual(self.watch(), ["10.0.0.1 ().md"])
+
+        # The cut off line is read again once it's complete, and a repeated host is merged
+        self.append("a.gnmap", "43/open/tcp//https///\nHost: 10.0.0.1 ()\tPorts: 22/open/tcp//ssh///\n")
+        self.assertEqual(self.watch(), ["10.0.0.1 ().md", "10.0.0.2 ().md"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.1 ().md"), "openPorts"), ["80", "22"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.0.2 ().md"), "openPorts"), ["443"])
+
+    def test_partial_xml_hosts_are_held_back(self):
+        second_host = XML_HOST.format("10.0.1.2", "21", "ftp")
+        self.append("b.xml", XML_HEADER + XML_HOST.format("10.0.1.1", "80", "http") + second_host[:60])
+        self.assertEqual(self.watch(), ["10.0.1.1 ().md"])
+
+        # Nothing new is complete yet
+        self.append("b.xml", second_host[60:90])
+        self.assertEqual(self.watch(), ["10.0.1.1 ().md"])
+
+        self.append("b.xml", second_host[90:] + "<host><status")
+        self.assertEqual(self.watch(), ["10.0.1.1 ().md", "10.0.1.2 ().md"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.1.2 ().md"), "openPorts"), ["21"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.1.2 ().md"), "services"), ["ftp"])
+
+        self.append("b.xml", ' state="up"/><address addr="10.0.1.3" addrtype="ipv4"/><hostnames/><ports><port '
+                    + 'protocol="tcp" portid="25"><state state="open"/><service name="smtp"/></port></ports></host>\n'
+                    + "</nmaprun>\n")
+        self.assertEqual(self.watch(), ["10.0.1.1 ().md", "10.0.1.2 ().md", "10.0.1.3 ().md"])
+        self.assertEqual(read_list(os.path.join(self.content, "10.0.1.1 ().md"), "openPorts"), ["80"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,22 +5,206 @@ import io
 import argparse
 import shutil
 import re
+import json
+import hashlib
+import tempfile
+import threading
+import time
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
+import sqlite3
+import contextlib
+import cProfile
+import itertools
+import ctypes
+import ctypes.util
+import select
+import math
+import signal
+import glob
+import csv
+import gzip
+import lzma
+import bz2
+import queue
+import bisect
+import ipaddress
+import socket
+
+from hoststore import HostStore, host_key
+
+# fcntl only exists on Unix and is only needed for reflinks, which fall back to copies without it
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Pillow is only needed for screenshot thumbnails, the images command embeds full size screenshots without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # To add your own templates, add a .md file to ./templates/ and then add the name here (case sensitive)
 TEMPLATES = ["Finding.md", "External-Host.md", "Internal-Host.md", "Persona.md"]
 
 # If you want certain files present when initializing an op, add a .md to ./templates/ 
 # and add the name here (case sensitive)
-# If you want to replace text that isn't OpName, you'll need to add your own replace_x function and call it
-# in write_host_notes or write_stock_files
 STOCK_FILES_ALL = ["Op-Findings.md", "Op-Tracker.md"]
 STOCK_FILES_INTERNAL = ["Op-Canvas.canvas", "Op-DomainInfo.md"]
 
-# Variable to hold file name:metadata mappings
-# Typically of format {ip:{"rdns":gnmap_rdns, "domains":[], "ports":[], "services":[]}}
-# Yes, I should have written this as a class
-# If --host-list is intentionally supplied with --gnmap, the "ip" key will include domains without an ip
-HOSTS = {}
+# Text in the templates and stock files that gets replaced when files are created (case sensitive)
+# OpName is always filled in with the op name. To replace your own text, add it here and supply
+# the value with --var Name=value on the command line
+TEMPLATE_VARIABLES = ["OpName"]
+
+# Frontmatter fields in the host templates that get filled with lists parsed from scan data,
+# of format {frontmatter field:key in the host_data dict}
+HOST_LIST_FIELDS = {"openPorts": "ports", "services": "services", "serviceVersions": "versions",
+                    "scriptOutput": "scripts"}
+TEMPLATE_LIST_FIELDS = list(HOST_LIST_FIELDS) + ["aliases"]
+# Fields left out of a note entirely unless it's rendered with a list for them, so only --aliases notes have aliases:
+OPTIONAL_LIST_FIELDS = ["aliases"]
+
+# NSE script output is collapsed onto one line and cut off at this many characters for the frontmatter
+SCRIPT_OUTPUT_LIMIT = 300
+
+# Folders passed to parse -g are searched for files with these extensions, also when followed by one of
+# COMPRESSED_EXTENSIONS (e.g. scan.gnmap.gz). The compression itself is detected from the file, see get_opener
+GNMAP_EXTENSIONS = [".gnmap"]
+COMPRESSED_EXTENSIONS = [".gz", ".xz", ".bz2"]
+
+# masscan/JSON-lines port records are grouped by IP this many records at a time before notes are written
+PORT_RECORD_BATCH_SIZE = 100000
+
+# Values for TEMPLATE_VARIABLES other than OpName, of format {name:value}. Set from --var
+TEMPLATE_VALUES = {}
+
+# Compiled templates are cached here (and on disk in templates/.cache) keyed by file modification time
+COMPILED_TEMPLATES = {}
+TEMPLATE_CACHE_VERSION = 2
+
+# Parsed hosts are passed around as host_data dicts of format
+# {"rdns":gnmap_rdns, "domains":[], "ports":[], "services":[], "versions":[], "scripts":[]}
+# Use new_host() to create one. Hosts that need to be collected before their notes are written are kept
+# in a HostStore (see hoststore.py), which stores them compactly and merges repeats of the same host
+
+# Hosts parse has written a note for, of format {host_key(ip):reverse DNS the note was named with}. Shared by every
+# input, so a host that shows up again (in the same scan or another one) is merged into the note it already has
+PARSED_HOSTS = {}
+
+# Notes generated by parse and the hash of the scan data written to each are kept in the manifest table of the
+# index, so later runs with --incremental can skip unchanged hosts. It is looked up a note at a time, not loaded
+# Entries changed since the manifest was last saved, of format {file_name:hash or None for a removed note}.
+# Written to the index by save_manifest at each checkpoint or once MANIFEST_BATCH_SIZE have changed
+MANIFEST_CHANGES = {}
+MANIFEST_BATCH_SIZE = 5000
+# Earlier versions kept the manifest in this file in the op folder, load_manifest moves it into the index
+MANIFEST_NAME = ".vault-generator-manifest.json"
+INCREMENTAL = False
+
+# SQLite index of the notes in an op's Content folder, used by the query command
+# Kept in the op folder and updated during parse, see the Index section
+INDEX = None
+INDEX_NAME = ".vault-index.sqlite"
+# Rows for the notes written since the index was last flushed, of format {file_name:{"ip", "rdns", "replace",
+# "ports", "services"}}. Added to the index a batch at a time by flush_index, at most INDEX_BATCH_SIZE notes at once
+INDEX_PENDING = {}
+INDEX_BATCH_SIZE = 5000
+# Notes per DELETE ... WHERE note IN (...), SQLite before 3.32 allows at most 999 parameters in a statement
+INDEX_DELETE_CHUNK = 500
+
+# Files copied into new vaults are first put in a content-addressed store (templates/.assets by default, or
+# --asset-store) and reflinked or hardlinked from there, see the Asset section. Modes: auto, reflink, hardlink, copy
+# Only the plugin files listed in HARDLINK_ASSETS are ever hardlinked, since Obsidian rewrites the settings files
+ASSET_STORE_PATH = None
+ASSET_LINK = "auto"
+ASSET_LINK_MODES = ["auto", "reflink", "hardlink", "copy"]
+HARDLINK_ASSETS = ["main.js", "styles.css", "manifest.json"]
+# Linux ioctl for cloning a file's extents (btrfs, XFS, etc.)
+FICLONE = 0x40049409
+
+# Static port/service/subnet rollup notes written to OpName/Rollups from the index after every parse
+# of format {kind used in the rollup note names:title of the summary note linked from the tracker}
+ROLLUP_FOLDER = "Rollups"
+ROLLUP_KINDS = {"Port": "Ports", "Service": "Services", "Subnet": "Subnets"}
+
+# Generated host canvases are split so no canvas has more than this many host nodes (--max-nodes)
+# Obsidian gets sluggish well before a thousand nodes
+CANVAS_MAX_NODES = 300
+CANVAS_NODE_WIDTH = 320
+CANVAS_NODE_HEIGHT = 200
+CANVAS_GAP = 40
+# Groups are placed left to right and wrap onto a new row past this width
+CANVAS_ROW_WIDTH = 6000
+
+# Columns written by the export command. Host rows take these frontmatter fields from the notes, finding rows only
+# fill in type and note (OpName-Findings#Heading), the rest are null/empty. Notes are read in chunks of EXPORT_CHUNK_SIZE by a process pool
+EXPORT_FIELDS = ["openPorts", "services", "examined", "finding", "followUp", "privilegeLevel"]
+EXPORT_COLUMNS = ["type", "note", "ip"] + EXPORT_FIELDS
+EXPORT_FLAGS = ["examined", "finding", "followUp"]
+EXPORT_CHUNK_SIZE = 500
+
+# The images command stores each distinct screenshot once, named by its content hash, in Images/Screenshots, plus a
+# downscaled copy in Images/Screenshots/Thumbnails (with Pillow installed) that is what gets embedded in the notes
+SCREENSHOT_EXTENSIONS = [".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp"]
+SCREENSHOT_FOLDER = "Screenshots"
+THUMBNAIL_FOLDER = "Thumbnails"
+THUMBNAIL_SIZE = 400
+SCREENSHOT_HEADING = "# Screenshots"
+
+# File offsets reached by the watch command, stored in the op folder so it can pick up where it left off
+WATCH_STATE_NAME = ".vault-generator-watch.json"
+WATCH_EXTENSIONS = [".gnmap", ".xml"]
+# New scan output is read this many bytes at a time, so catching up on a large file never loads all of it at once,
+# and the hosts read so far are written out early once there are this many of them
+WATCH_READ_SIZE = 4 * 1024 * 1024
+WATCH_FLUSH_HOSTS = 5000
+
+# How host notes are laid out in Content. "flat" puts every note directly in Content, "subnet" and "domain"
+# put them in one subfolder per /24 or registered domain, each with a generated index note (see Layout section)
+# The layout is stored in the op folder by init/parse --layout so every later run uses the same one
+LAYOUTS = ["flat", "subnet", "domain"]
+LAYOUT = "flat"
+LAYOUT_NAME = ".vault-generator-layout"
+# With --aliases an IP gets one note, named "ip (rdns).md", with its domains in the aliases frontmatter instead
+# of one note per domain. Stored in the layout file, see the Alias section
+ALIAS_NOTES = False
+SHARD_INDEX_PREFIX = "Index - "
+# Public suffixes with two labels, so a.client.co.uk shards under client.co.uk rather than co.uk
+SECOND_LEVEL_SUFFIXES = ["co.uk", "org.uk", "ac.uk", "gov.uk", "com.au", "net.au", "org.au", "co.nz", "co.jp",
+                         "co.za", "com.br", "com.cn", "com.mx", "co.in", "com.sg"]
+# Shard folders written to since the last time the index notes were regenerated
+SHARDS_TOUCHED = set()
+
+# Per-phase timings and counters collected for --stats, see Stats. None when --stats isn't used
+STATS = None
+
+# Checkpoints of how far parse has got through each input, so --resume can pick up after a crash. See Journal
+JOURNAL = None
+JOURNAL_NAME = ".vault-generator-journal.jsonl"
+JOURNAL_INTERVAL = 5000
+# Set by the first Ctrl-C during parse, which stops at the next checkpointable record instead of mid-write
+INTERRUPTED = False
+
+# Inputs compressed with gzip, xz or bzip2 are detected by their first bytes and decompressed while they're read,
+# a chunk at a time on a background thread so decompression overlaps with parsing (see read_compressed_lines)
+COMPRESSION_OPENERS = [(b"\x1f\x8b", gzip.open), (b"\xfd7zXZ\x00", lzma.open), (b"BZh", bz2.open)]
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+# Decompressed chunks waiting to be parsed, so a slow parse doesn't pile up the whole file in memory
+DECOMPRESS_QUEUE_SIZE = 8
+
+# Hosts outside parse --scope or inside --exclude are dropped before they get a note, see Scope
+SCOPE = None
+
+# Batched writer used by parse for host notes, see NoteWriter
+WRITER = None
+DEFAULT_WORKERS = 8
+
+# mkstemp creates files only their owner can read, so files written through a temp file get the mode open() would
+# have used instead (see set_file_mode). The umask can only be read by setting it, so it's read once at startup
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 #                 #
 # Helpers Section #
@@ -73,55 +257,418 @@ def get_file_contents(path):
 
     return contents
 
-def write_file(path, file_name, contents):
+def read_lines(path, offset=0, position=None):
+    """
+    Yields the lines of a file one at a time, without line endings, so large
+    scan outputs never need to be held in memory all at once
+    Reading can start at a byte offset, and if a position dict is supplied, position["offset"]
+    is kept at the byte offset just past the last line yielded (used by the parse journal)
+    gzip, xz and bzip2 files are decompressed as they're read
+    """
+    opener = get_opener(path)
+    if opener is not open:
+        yield from read_compressed_lines(path, opener, offset, position)
+        return
+
+    if offset != 0 or position is not None:
+        yield from read_lines_at(path, offset, position)
+        return
+
+    with open(path, "r") as f:
+        if STATS is None:
+            for line in f:
+                yield line.rstrip("\r\n")
+            return
+
+        # Same as above, but keeps track of how long is spent waiting on the file
+        lines = iter(f)
+        while True:
+            start_time = time.perf_counter()
+            line = next(lines, None)
+            STATS.add_time("read", time.perf_counter() - start_time)
+
+            if line is None:
+                return
+
+            STATS.count("lines_read")
+            yield line.rstrip("\r\n")
+
+def read_lines_at(path, offset, position):
+    # Text mode files can't report their position while being iterated, so read bytes and decode each line
+    if position is None:
+        position = {}
+    position["offset"] = offset
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        lines = iter(f)
+        while True:
+            start_time = time.perf_counter()
+            line = next(lines, None)
+            if STATS is not None:
+                STATS.add_time("read", time.perf_counter() - start_time)
+
+            if line is None:
+                return
+
+            position["offset"] += len(line)
+            stats_count("lines_read")
+            yield line.decode(errors="replace").rstrip("\r\n")
+
+def get_opener(path):
+    """
+    Returns the function to open a file with: gzip.open, lzma.open or bz2.open if
+    it's compressed, otherwise open
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+
+    for prefix, opener in COMPRESSION_OPENERS:
+        if magic.startswith(prefix):
+            return opener
+
+    return open
+
+def read_compressed_lines(path, opener, offset=0, position=None):
+    """
+    read_lines for compressed files. A background thread decompresses the file a chunk at a time
+    while the lines are parsed. Offsets are in decompressed bytes, and since compressed files can't
+    seek, the lines before the offset are decompressed and skipped
+    """
+    chunks = queue.Queue(DECOMPRESS_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up once the reader is gone, e.g. the parse failed part way through
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def decompress():
+        try:
+            with opener(path, "rb") as f:
+                while not stop.is_set():
+                    chunk = f.read(DECOMPRESS_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    put(chunk)
+        except Exception as e:
+            put(e)
+        put(None)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+
+    if position is None:
+        position = {}
+    position["offset"] = 0
+    remainder = b""
+    try:
+        while True:
+            start_time = time.perf_counter()
+            chunk = chunks.get()
+            if STATS is not None:
+                STATS.add_time("read", time.perf_counter() - start_time)
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            # The last line of the file may not end with a newline
+            if chunk is None:
+                lines = [remainder] if remainder != b"" else []
+            else:
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+
+            for line in lines:
+                position["offset"] += len(line) + (1 if chunk is not None else 0)
+                if position["offset"] <= offset:
+                    continue
+                stats_count("lines_read")
+                yield line.decode(errors="replace").rstrip("\r")
+
+            if chunk is None:
+                return
+    finally:
+        stop.set()
+        thread.join()
+
+def write_text_atomic(file_path, text):
+    """
+    Writes the text to a temp file next to the destination and renames it into place
+    so Obsidian never sees a half-written file. Returns the number of bytes written
+    """
+    folder, file_name = os.path.split(file_path)
+    data = text.encode()
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix="." + file_name[:32], suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        set_file_mode(temp_path, file_path)
+        os.replace(temp_path, file_path)
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    return len(data)
+
+def set_file_mode(temp_path, file_path):
+    """
+    Gives a temp file the mode of the file it's about to replace, or the umask
+    honouring mode of a new file if there isn't one yet
+    """
+    try:
+        mode = os.stat(file_path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+
+    os.chmod(temp_path, mode)
+
+def write_file(path, file_name, text):
     file_path = os.path.join(path, file_name)
     try:
-        with open(file_path, "w") as f:
-            f.write("\n".join(contents))
+        write_text_atomic(file_path, text)
     except Exception as e:
         print("Error writing to file: {0}.\n\nError: {1}".format(file_path, e))
 
+class Stats:
+    """
+    Per-phase timings and counters for --stats. Safe to update from the writer threads.
+    Phase times are the time spent in that phase only, summed across threads
+    """
+    def __init__(self, command):
+        self.command = command
+        self.start_time = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+
+    def report(self):
+        total_time = time.perf_counter() - self.start_time
+        stats = {"command": self.command, "total_seconds": round(total_time, 4),
+                 "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+                 "counters": self.counters}
+
+        print(json.dumps(stats, indent=2))
+
+def stats_phase(name):
+    if STATS is None:
+        return contextlib.nullcontext()
+
+    return STATS.phase(name)
+
+def stats_count(name, amount=1):
+    if STATS is not None:
+        STATS.count(name, amount)
+
+def run_command(handler, args, stats=False, profile_path=None):
+    """
+    Runs a handle_x function, collecting --stats and writing a --profile if asked for
+    """
+    global STATS
+    if stats:
+        STATS = Stats(handler.__name__.replace("handle_", ""))
+
+    profiler = None
+    if profile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        handler(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            try:
+                profiler.dump_stats(profile_path)
+                print("[+] Profile written to {0}. View it with: python -m pstats {0}".format(profile_path))
+            except Exception as e:
+                print("[!] Error writing profile. Error: {0}".format(e))
+
+        if STATS is not None:
+            STATS.report()
+            STATS = None
+
 def strip_domain(domain):
     domain = re.sub(r"https?://", "", domain.lower())
     domain = re.sub(r"/.*", "", domain)
 
     return domain
 
-def replace_op_name(contents, op_name):
-    updated_content = [sub.replace('OpName', op_name) for sub in contents]
+def iter_chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
-    return updated_content
 
-def replace_frontmatter(contents, data, field_name):
+#                  #
+# Template section #
+#                  #
+# Templates are compiled once into a list of segments. A segment is either literal text or a slot:
+#   ["var", name]   - replaced with the value of a TEMPLATE_VARIABLES entry
+#   ["list", field] - the yaml list items for a TEMPLATE_LIST_FIELDS frontmatter field
+#   ["optional", field, line] - the whole line of an OPTIONAL_LIST_FIELDS field and its list items, or nothing
+# Rendering is then a single join over the segments
+
+def compile_template(contents):
     """
-    Takes a list of data, converts it to indented yaml, and inserts
-    it at the designated field name in the template contents.
+    Takes the lines of a template and returns its compiled segments
     """
-    spacer = "  - "
-    data_yaml = []
-    insert_index = None
-    new_contents = contents[:]
-    
-    # Generate appropriate yaml
-    for item in data:
-        data_yaml.append(spacer + "\"" + item + "\"")
+    segments = []
+    literal = []
+    variable_names = sorted(TEMPLATE_VARIABLES, key=len, reverse=True)
+    variable_regex = re.compile("(" + "|".join(re.escape(name) for name in variable_names) + ")")
+    remaining_fields = list(TEMPLATE_LIST_FIELDS)
+    in_frontmatter = len(contents) > 0 and contents[0].strip() == "---"
+
+    def flush():
+        if len(literal) != 0:
+            segments.append("".join(literal))
+            literal.clear()
 
-    # Get the index to insert ports
     for i,line in enumerate(contents):
-        if field_name in line:
-            insert_index = i + 1
-            break
+        if i > 0 and in_frontmatter and line.strip() == "---":
+            in_frontmatter = False
+
+        optional_field = None
+        if in_frontmatter:
+            optional_field = next((field_name for field_name in OPTIONAL_LIST_FIELDS
+                                   if field_name in remaining_fields and line.startswith(field_name + ":")), None)
+        if optional_field is not None:
+            flush()
+            segments.append(["optional", optional_field, line])
+            remaining_fields.remove(optional_field)
+            continue
 
-    if insert_index is not None:
-        new_contents[insert_index:insert_index] = data_yaml
+        for part in variable_regex.split(line):
+            if part in TEMPLATE_VARIABLES:
+                flush()
+                segments.append(["var", part])
+            elif part != "":
+                literal.append(part)
 
-    return new_contents
+        # The list items go right after the field name, e.g. openPorts:
+        if in_frontmatter:
+            for field_name in remaining_fields:
+                if line.startswith(field_name + ":"):
+                    flush()
+                    segments.append(["list", field_name])
+                    remaining_fields.remove(field_name)
+                    break
+
+        if i != len(contents) - 1:
+            literal.append("\n")
+
+    flush()
+
+    return segments
+
+def render_template(template, values, lists=None):
+    """
+    Renders compiled template segments. values is {variable name:text} and
+    lists is {frontmatter field:[items]}. Variables without a value are left as-is
+    """
+    if lists is None:
+        lists = {}
+
+    parts = []
+    for segment in template:
+        if type(segment) is str:
+            parts.append(segment)
+        elif segment[0] == "var":
+            parts.append(values.get(segment[1], segment[1]))
+        elif segment[0] == "optional":
+            if segment[1] in lists:
+                parts.append(segment[2] + "".join("\n  - " + yaml_quote(item) for item in lists[segment[1]]) + "\n")
+        else:
+            parts.append("".join("\n  - " + yaml_quote(item) for item in lists.get(segment[1], [])))
+
+    return "".join(parts)
+
+def yaml_quote(item):
+    return "\"" + item.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") + "\""
+
+def get_template_values(op_name):
+    values = dict(TEMPLATE_VALUES)
+    values["OpName"] = op_name
+
+    return values
+
+def get_template_cache_path(template_path):
+    cache_folder = os.path.join(get_template_directory(), ".cache")
+
+    return os.path.join(cache_folder, os.path.basename(template_path) + ".json")
+
+def load_template(template_path):
+    """
+    Returns the compiled form of a template file. Compiled templates are cached in memory and
+    on disk, and are recompiled when the template (or the variable/field lists) change
+    """
+    stat = os.stat(template_path)
+    key = {"version": TEMPLATE_CACHE_VERSION, "path": os.path.abspath(template_path), "mtime": stat.st_mtime_ns,
+           "size": stat.st_size, "variables": TEMPLATE_VARIABLES, "fields": TEMPLATE_LIST_FIELDS}
+    memo_key = json.dumps(key, sort_keys=True)
+
+    if memo_key in COMPILED_TEMPLATES:
+        return COMPILED_TEMPLATES[memo_key]
+
+    cache_path = get_template_cache_path(template_path)
+    template = None
+
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            template = cached["segments"]
+    except Exception:
+        pass
+
+    if template is None:
+        template = compile_template(get_file_contents(template_path))
+
+        # The cache is only a speed up, so failing to write it (e.g. read-only install) is fine
+        try:
+            create_directory(os.path.dirname(cache_path))
+            write_text_atomic(cache_path, json.dumps({"key": key, "segments": template}))
+        except Exception:
+            pass
+
+    COMPILED_TEMPLATES[memo_key] = template
+
+    return template
 
 
 #              #
 # Init section #
 #              #
-def handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, include_templates):
+def handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, include_templates, layout=None,
+                prompt=True, aliases=False):
     
     # Get the respective paths
     # New, reusable vault for multiple ops. Does not use op name for vault name
@@ -142,6 +689,9 @@ def handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, includ
     template_folder_path = os.path.join(vault_path, "01-Templates")
 
     # Do a quick check to see if this op already exists
+    if os.path.exists(op_folder_path) and not prompt:
+        print("[!] {0} already exists, skipping it.".format(op_folder_path))
+        return False
     if os.path.exists(op_folder_path):
         print("\n[!] WARNING: The supplied op name and folder already exists. This will overwrite the contents of "
             + "that folder. Do you want to continue?", end="(y/N): ")
@@ -152,7 +702,8 @@ def handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, includ
 
     # Create the vault structure if desired, otherwise just the folder
     if is_new_vault:
-        create_vault(vault_path, op_folder_path, template_folder_path)
+        with stats_phase("create_vault"):
+            create_vault(vault_path, op_folder_path, template_folder_path)
     else:
         try:
             create_directory(op_folder_path)
@@ -162,7 +713,8 @@ def handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, includ
             sys.exit(1)
 
         if include_templates:
-            add_template_folder(op_folder_path + "/01-Templates")
+            with stats_phase("copy_templates"):
+                add_template_folder(op_folder_path + "/01-Templates")
 
     # Add the sub folders inside the new op
     try:
@@ -174,7 +726,49 @@ def handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, includ
         sys.exit(1)
 
     # Add the starting files with appropriate names
-    write_stock_files(op_folder_path, op_name, op_type)
+    with stats_phase("stock_files"):
+        write_stock_files(op_folder_path, op_name, op_type)
+
+    if layout is not None or aliases:
+        save_layout(op_folder_path, layout or "flat", aliases)
+
+    return True
+
+def handle_batch_init(folder_path, batch_path, is_new_vault, is_reusable, include_templates, layout=None,
+                      aliases=False):
+    """
+    Creates every op listed in the batch file (OpName,internal|external per line) in one run
+    With --vault --reusable the vault is created once and the rest of the ops are added to it
+    """
+    ops = []
+    for line_number, line in enumerate(read_lines(batch_path), start=1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+
+        op_name, _, op_type = [part.strip() for part in line.partition(",")]
+        if op_type.lower() not in ["internal", "external"]:
+            print("Error: Line {0} of the batch file needs OpName,internal or OpName,external: {1}".format(
+                line_number, line))
+            sys.exit(1)
+        ops.append((op_name, op_type.lower()))
+
+    created = 0
+    start_time = time.perf_counter()
+    for index, (op_name, op_type) in enumerate(ops):
+        if is_new_vault and is_reusable and index > 0:
+            # The reusable vault exists after the first op, just add to it
+            result = handle_init(os.path.join(folder_path, "AssessmentNotes"), op_name, op_type, False, False,
+                                 include_templates, layout, False, aliases)
+        else:
+            result = handle_init(folder_path, op_name, op_type, is_new_vault, is_reusable, include_templates, layout,
+                                 False, aliases)
+
+        if result:
+            created += 1
+            stats_count("ops")
+
+    print("[+] Created {0} of {1} ops in {2:.2f}s".format(created, len(ops), time.perf_counter() - start_time))
 
 def create_vault(vault_path, op_folder_path, template_folder_path):
     # Creates the vault and op folder together if the vault is reusable
@@ -209,7 +803,11 @@ def copy_obsidian_dir(vault_path):
         return
 
     try:
-        shutil.copytree(source_path, dest_path)
+        for root, _, files in os.walk(source_path):
+            folder = os.path.normpath(os.path.join(dest_path, os.path.relpath(root, source_path)))
+            create_directory(folder)
+            for file in files:
+                link_asset(os.path.join(root, file), os.path.join(folder, file), file in HARDLINK_ASSETS)
     except Exception as e:
         print("Error copying obsidian directory to vault.\n\nError: {0}".format(e))
 
@@ -221,7 +819,7 @@ def copy_templates(template_folder_path):
         source_path = os.path.join(fresh_template_path, template)
         dest_path = os.path.join(template_folder_path, template)
         try:
-            shutil.copy(source_path, dest_path)
+            link_asset(source_path, dest_path)
         except Exception as e:
             print("Error copying template(s): {0}".format(e))
 
@@ -230,43 +828,35 @@ def write_stock_files(op_folder_path, op_name, op_type):
     global STOCK_FILES
     global STOCK_FILES_INTERNAL
     stock_files_path = get_template_directory()
+    values = get_template_values(op_name)
 
+    stock_files = STOCK_FILES_ALL[:]
+    if op_type == "internal":
+        stock_files += STOCK_FILES_INTERNAL
 
-    for file in STOCK_FILES_ALL:
+    for file in stock_files:
         source_path = os.path.join(stock_files_path, file)
     
         try:
-            contents = get_file_contents(source_path)
+            template = load_template(source_path)
         except Exception as e:
             print("[!] Error fetching contents of stock file: {0}\nError: {1}".format(file, e))
+            continue
     
-        replaced_text = replace_op_name(contents, op_name)
         file_name = file.replace("Op", op_name)
-        write_file(op_folder_path, file_name, replaced_text)
+        write_file(op_folder_path, file_name, render_template(template, values))
 
     if op_type == "internal":
-        for file in STOCK_FILES_INTERNAL:
-            source_path = os.path.join(stock_files_path, file)
-
-            try:
-                contents = get_file_contents(source_path)
-            except Exception as e:
-                print("[!] Error fetching contents of stock file: {0}\nError: {1}".format(file, e))
-
-            replaced_text = replace_op_name(contents, op_name)
-            file_name = file.replace("Op", op_name)
-            write_file(op_folder_path, file_name, replaced_text)
-
         # Stage a patient zero (witting click or initial access)
         source_path = os.path.join(stock_files_path, "Internal-Host.md")
 
         try:
-            contents = get_file_contents(source_path)
+            template = load_template(source_path)
         except Exception as e:
-            print("[!] Error fetching contents of stock file: {0}\nError: {1}".format(file, e))
+            print("[!] Error fetching contents of stock file: {0}\nError: {1}".format("Internal-Host.md", e))
+            return
     
-        replaced_text = replace_op_name(contents, op_name)
-        write_file(os.path.join(op_folder_path, "Content"), "Patient-Zero.md", replaced_text)
+        write_file(os.path.join(op_folder_path, "Content"), "Patient-Zero.md", render_template(template, values))
 
 
 #               #
@@ -295,34 +885,153 @@ def is_initialized(path):
     return initialized
 
 
-def handle_parse(folder_path, op_name, op_type, host_list_path, gnmap_path, host_map_path):
-    gnmap_present = False
+def handle_parse(folder_path, op_name, op_type, host_list_path, gnmap_paths, host_map_path, incremental=False,
+                 workers=DEFAULT_WORKERS, xml_path=None, masscan_path=None, json_lines_path=None,
+                 batch_size=PORT_RECORD_BATCH_SIZE, layout=None, resume=False, aliases=False, scope_path=None,
+                 exclude_path=None):
+    global INCREMENTAL
+    global WRITER
+    global INDEX
+    global JOURNAL
+    global SCOPE
+    global PARSED_HOSTS
+    correlator = HostCorrelator()
+    hosts = HostStore()
+    scanned_hosts = None
+    gnmap_files = get_gnmap_files(gnmap_paths)
+    scan_paths = gnmap_files + [xml_path, masscan_path, json_lines_path]
+    scan_present = any(path is not None for path in scan_paths)
+    INCREMENTAL = incremental
+    INDEX = open_index(folder_path)
+    load_manifest(INDEX, folder_path)
+    load_layout(folder_path)
+
+    if layout is not None and layout != LAYOUT:
+        # Notes already written would be duplicated in the new layout rather than moved
+        if has_manifest_notes(INDEX):
+            print("Error: This op already has notes in the {0} layout. Start a new op folder to use the {1} "
+                  "layout.".format(LAYOUT, layout))
+            sys.exit(1)
+        save_layout(folder_path, layout, ALIAS_NOTES)
+        load_layout(folder_path)
+
+    if aliases and not ALIAS_NOTES:
+        if has_manifest_notes(INDEX):
+            print("Error: This op already has a note per domain. Run the collapse command to merge them into one "
+                  "note per IP, which also switches the op to --aliases.")
+            sys.exit(1)
+        save_layout(folder_path, LAYOUT, True)
+        load_layout(folder_path)
 
     # Figure out which one(s) of these exists
     if host_list_path is not None:
         if not validate_path(host_list_path):
             print("Error: The supplied host-list could not be found: {0}".format(host_list_path))
             sys.exit(1)
-        parse_host_list(host_list_path)
+        with stats_phase("host_list"):
+            try:
+                correlator.add_host_list(host_list_path)
+            except Exception as e:
+                print("[!] Error fetching contents of host list. Error: {0}".format(e))
+
+    if gnmap_paths is not None and len(gnmap_files) == 0:
+        print("Error: No gnmap files found for: {0}".format(", ".join(gnmap_paths)))
+        sys.exit(1)
+
+    if xml_path is not None:
+        if not validate_path(xml_path):
+            print("Error: The supplied nmap xml file could not be found: {0}".format(xml_path))
+            sys.exit(1)
 
-    if gnmap_path is not None:
-        if not validate_path(gnmap_path):
-            print("Error: The supplied gnmap file could not be found: {0}".format(gnmap))
+    for path in [masscan_path, json_lines_path]:
+        if path is not None and not validate_path(path):
+            print("Error: The supplied port record file could not be found: {0}".format(path))
             sys.exit(1)
-        gnmap_present = True
-        parse_gnmap(gnmap_path)
 
     if host_map_path is not None:
         if not validate_path(host_map_path):
             print("Error: The supplied host-map could not be found: {0}".format(host_map_path))
             sys.exit(1)
-        parse_host_map(host_map_path, gnmap_present)
 
-    write_host_notes(folder_path, op_name, op_type)
+        # Scans are streamed straight to notes, so the domains need to be known up front
+        with stats_phase("host_map"):
+            try:
+                correlator.add_host_map(host_map_path)
+            except Exception as e:
+                print("[!] Error fetching contents of host map file. Error: {0}".format(e))
 
-def write_host_notes(folder_path, op_name, op_type):
-    global HOSTS
-    content_folder = os.path.join(folder_path, "Content")
+    # The scope is checked before anything is added to a HostStore or written, so it's needed first of all
+    if scope_path is not None or exclude_path is not None:
+        for path in [scope_path, exclude_path]:
+            if path is not None and not validate_path(path):
+                print("Error: The supplied scope file could not be found: {0}".format(path))
+                sys.exit(1)
+        with stats_phase("scope"):
+            SCOPE = Scope(scope_path, exclude_path)
+
+    # One gnmap file is streamed straight to notes. Several are parsed side by side and merged first,
+    # so a host scanned from more than one node gets a single note with every port
+    if len(gnmap_files) > 1:
+        with stats_phase("gnmap_merge"):
+            scanned_hosts = parse_gnmap_files(gnmap_files)
+
+    WRITER = NoteWriter(workers)
+    fingerprint = get_parse_fingerprint([host_list_path, host_map_path, xml_path, masscan_path, json_lines_path,
+                                         scope_path, exclude_path] + gnmap_files, [op_name, op_type, incremental, batch_size, LAYOUT,
+                                         ALIAS_NOTES, TEMPLATE_VALUES])
+    JOURNAL = Journal(folder_path, fingerprint, resume)
+    PARSED_HOSTS = JOURNAL.pop_seen()
+    finished = False
+    previous_handler = signal.signal(signal.SIGINT, handle_interrupt)
+    try:
+        if scanned_hosts is not None:
+            stream_host_notes(folder_path, op_name, op_type, scanned_hosts.items(), correlator, "gnmap")
+        elif len(gnmap_files) == 1:
+            stream_gnmap_notes(folder_path, op_name, op_type, gnmap_files[0], correlator)
+
+        if xml_path is not None:
+            stream_nmap_xml_notes(folder_path, op_name, op_type, xml_path, correlator)
+
+        if masscan_path is not None:
+            stream_port_record_notes(folder_path, op_name, op_type, masscan_path, False, correlator, batch_size)
+
+        if json_lines_path is not None:
+            stream_port_record_notes(folder_path, op_name, op_type, json_lines_path, True, correlator, batch_size)
+
+        # Whatever wasn't joined to a scanned host gets its own note
+        for host, host_data in correlator.iter_unmatched(scan_present):
+            if SCOPE is not None and not SCOPE.check(host if is_ip(host) else None, host_data):
+                continue
+            hosts.merge(host, host_data)
+
+        write_host_notes(folder_path, op_name, op_type, hosts)
+        finished = True
+    finally:
+        WRITER.close()
+        WRITER.report()
+        WRITER = None
+        with stats_phase("shard_index"):
+            write_shard_indexes(os.path.join(folder_path, "Content"))
+        save_manifest(INDEX)
+        flush_index(INDEX)
+        with stats_phase("rollups"):
+            write_rollups(INDEX, folder_path, op_name)
+        INDEX.commit()
+        INDEX.close()
+        INDEX = None
+        JOURNAL.close(finished)
+        JOURNAL = None
+        PARSED_HOSTS = {}
+        signal.signal(signal.SIGINT, previous_handler)
+        if SCOPE is not None:
+            print("[*] Skipped {0} out of scope records".format(SCOPE.filtered))
+            stats_count("out_of_scope", SCOPE.filtered)
+            SCOPE = None
+
+def get_host_template(op_type):
+    """
+    Returns the compiled host template for the op type
+    """
     template_path = get_template_directory()
 
     # Get the right template
@@ -331,228 +1040,3171 @@ def write_host_notes(folder_path, op_name, op_type):
     else: 
         template_path = os.path.join(template_path, "External-Host.md")
 
-    # Get clean copies of the templates
-    fresh_contents = []
+    template = []
     try:
-        fresh_contents = get_file_contents(template_path)
+        template = load_template(template_path)
     except Exception as e:
         print(e)
         print("[!] Error fetching template contents ({0}) - Fatal. Exiting.".format(template_path))
         sys.exit(1)
 
-    for host in HOSTS:
-        # Don't muck up the clean copies with find/replace
-        contents = fresh_contents[:]
+    return template
 
-        contents = replace_op_name(contents, op_name)
-        file_name = ""
-        
-        # Handle non-IP entries from host-list
-        if not re.match(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}", host):
-            file_name = host + ".md"
-            write_file(content_folder, file_name, contents)
-            continue
+def write_host_notes(folder_path, op_name, op_type, hosts):
+    """
+    Writes a note for every host in a HostStore
+    """
+    content_folder = os.path.join(folder_path, "Content")
 
-        # Grab common values
-        rdns = HOSTS[host]["rdns"]
-        if len(HOSTS[host]["ports"]) != 0:
-            contents = replace_frontmatter(contents, HOSTS[host]["ports"], "openPorts")
-        if len(HOSTS[host]["services"]) != 0:
-            contents = replace_frontmatter(contents, HOSTS[host]["services"], "services")
+    if len(hosts) == 0:
+        return
+
+    template = get_host_template(op_type)
+
+    for host, host_data in iter_journaled("unmatched", hosts.items()):
+        stats_count("hosts")
+        write_host_note(content_folder, template, op_name, host, host_data)
+
+def get_host_file_names(host, host_data):
+    """
+    Returns the note file name(s) for a host entry, relative to Content
+    """
+    # Handle non-IP entries from host-list
+    if not is_ip(host):
+        return [get_note_path(host, host + ".md", host)]
 
-        # Separate hosts with no domain vs. ones with domain(s)
-        if len(HOSTS[host]["domains"]) == 0:
+    # Hosts that only came from a host map have no reverse DNS at all
+    rdns = host_data["rdns"]
+    if rdns == "":
+        rdns = "()"
+    note_host = get_note_host(host)
+    file_names = []
+
+    # Separate hosts with no domain vs. ones with domain(s). With --aliases the domains
+    # go in the frontmatter of the one note instead
+    if len(host_data["domains"]) == 0 or ALIAS_NOTES:
+        if rdns == '()':
+            file_names.append(get_note_path(host, note_host + " ().md"))
+        else:
+            file_names.append(get_note_path(host, note_host + " " + rdns + ".md", rdns))
+    else:
+        for domain in host_data["domains"]:
             if rdns == '()':
-                file_name = host + " ().md"
+                file_names.append(get_note_path(host, domain + " - (" + note_host + ").md", domain))
             else:
-                file_name = host + " " + rdns + ".md"
-            write_file(content_folder, file_name, contents)
-        else:
-            for domain in HOSTS[host]["domains"]:
-                if rdns == '()':
-                    file_name = domain + " - (" + host + ").md"
-                else:
-                    file_name = domain + " - (" + host + ") " + rdns + ".md"
+                file_names.append(get_note_path(host, domain + " - (" + note_host + ") " + rdns + ".md", domain))
 
-                write_file(content_folder, file_name, contents)
+    return file_names
 
+def get_note_host(ip):
+    # Colons aren't allowed in Windows/SMB file names, so IPv6 addresses are written with - like ipv6-literal.net names
+    return ip.replace(":", "-")
 
-def parse_host_list(host_list_path):
-    global HOSTS
-    try:
-        host_list = get_file_contents(host_list_path)
-    except Exception as e:
-        print("[!] Error fetching contents of host list. Error: {0}".format(e))
-        return
+def write_host_note(content_folder, template, op_name, host, host_data, merge=False):
+    """
+    Writes the note(s) for a single host entry of format
+    {"rdns":gnmap_rdns, "domains":[], "ports":[], "services":[]}
+    With merge, existing notes get the data merged in instead of being rewritten
+    """
+    file_names = get_host_file_names(host, host_data)
+    data_hash = hash_host_data(host_data)
 
-    for host in host_list:
-        host = strip_domain(host)
-        HOSTS[host] = {"rdns": "", "domains":[host], "ports": [], "services": []}
+    # Nothing to render if every note for this host is already up to date
+    if INCREMENTAL and not merge:
+        current_count = len(file_names)
+        file_names = [f for f in file_names if not is_note_current(content_folder, f, data_hash)]
+        stats_count("notes_unchanged", current_count - len(file_names))
+        if len(file_names) == 0:
+            return
 
+    # Render once and share the text between every file for this host
+    lists = {field_name: host_data[key] for field_name, key in HOST_LIST_FIELDS.items()}
+    if ALIAS_NOTES:
+        lists["aliases"] = host_data["domains"]
+    with stats_phase("render"):
+        text = render_template(template, get_template_values(op_name), lists)
 
-def parse_gnmap(gnmap_path):
-    global HOSTS
-    try:
-        contents = get_file_contents(gnmap_path)
-    except Exception as e:
-        print("[!] Error fetching contents of gnmap file. Error: {0}".format(e))
-        return
+    for file_name in file_names:
+        create_shard_folder(content_folder, file_name)
 
-    for line in contents:
-        # Skip lines that don't have open ports to parse
-        if not ("host" and "/open/" in line.lower()):
-            continue
+        # A note written earlier in the parse may still be queued, and it has to be on disk to merge into
+        if merge and WRITER.is_queued(file_name):
+            WRITER.flush()
 
-        # Get the sections of the gnmap that are useful as arrays
-        host_info = line.split('\t')[0].split(' ')
-        ports_info = line.split('\t')[1][7:].split(', ')
+        if (INCREMENTAL or merge) and os.path.exists(os.path.join(content_folder, file_name)):
+            WRITER.merge(content_folder, file_name, host_data)
+            merged = True
+        else:
+            WRITER.write(content_folder, file_name, text)
+            merged = False
 
-        # Get the IP and rdns (if available)
-        ip = host_info[1]
-        rdns = host_info[2]
+        # A repeat of a host only has part of its data, so the note keeps the hash of its first record. That's
+        # what an --incremental rerun compares against, and it merges the repeats into the note again anyway
+        if not merge or not merged:
+            update_manifest(INDEX, file_name, data_hash)
 
-        # Loop over the port strings and add # and services
-        host_ports = []
-        host_services = []
-        for port in ports_info:
+        if INDEX is not None:
+            index_host_note(INDEX, file_name, host_data, merged)
 
-            if not "/open/" in port.lower():
-                continue
 
-            port_num, state, proto, owner, service, rpc, version, empty = port.split("/")
+#               #
+# Write section #
+#               #
+class NoteWriter:
+    """
+    Writes host notes from a thread pool so slow (e.g. network mounted) shares don't
+    serialize the whole parse. Every note is written atomically with write_text_atomic.
+    The number of queued writes is capped so streamed input doesn't pile up in memory
+    """
+    def __init__(self, workers=DEFAULT_WORKERS):
+        workers = max(workers, 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.queued = threading.BoundedSemaphore(workers * 4)
+        # {future:file name} and {file name:number of writes queued for it}
+        self.pending = {}
+        self.pending_names = {}
+        self.lock = threading.Lock()
+        self.notes_written = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self.start_time = time.perf_counter()
+        self.elapsed = 0.0
 
-            host_ports.append(port_num)
+    def write(self, path, file_name, text):
+        self._submit(self._write, path, file_name, text)
 
-            if service != "" and not service in host_services:
-                host_services.append(service)
+    def merge(self, path, file_name, host_data):
+        self._submit(self._merge, path, file_name, host_data)
 
-            # Create the dict entry
-            HOSTS[ip] = {"rdns": rdns, "domains":[], "ports": host_ports, "services":host_services}
+    def is_queued(self, file_name):
+        with self.lock:
+            return file_name in self.pending_names
 
+    def flush(self):
+        """
+        Waits for every queued write to finish
+        """
+        with self.lock:
+            pending = list(self.pending)
 
-def parse_host_map(host_map_path, gnmap_present):
-    global HOSTS
-    try:
-        host_pairs = get_file_contents(host_map_path)
-    except Exception as e:
-        print("[!] Error fetching contents of host map file. Error: {0}".format(e))
-        return
+        with stats_phase("write_drain"):
+            concurrent.futures.wait(pending)
 
-    domain_index = 0
-    ip_index = 1
+    def close(self):
+        with stats_phase("write_drain"):
+            self.executor.shutdown(wait=True)
+        self.elapsed = time.perf_counter() - self.start_time
 
-    # A little error handling for bad user input that flips host and IP
-    test_str = host_pairs[1].split(",")
-    if re.match(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}", test_str[0]):
-        domain_index = 1
-        ip_index = 0
+        stats_count("notes_written", self.notes_written)
+        stats_count("bytes_written", self.bytes_written)
+        stats_count("write_errors", self.errors)
 
-    for host in host_pairs:
-        ip = ""
-        domain = ""
-        try:
-            temp_arr = host.split(",")
-            domain = temp_arr[domain_index]
-            ip = temp_arr[ip_index]
-        except IndexError as e:
-            print("[*] Missing full pair for {0} in host map. Skipping.".format(temp_arr[0]))
-            continue
+    def report(self):
+        if self.notes_written == 0 and self.errors == 0:
+            return
 
-        domain = strip_domain(domain)
-        if ip in HOSTS:
-            HOSTS[ip]["domains"].append(domain)
-        elif not gnmap_present:
-            # Only add hosts not already in the dict if there wasn't a gnmap parsed
-            # Avoids adding hosts without any open ports
-            HOSTS[ip] = {"rdns":"", "domains":[domain],"ports":[],"services":[]}
+        rate = self.notes_written / self.elapsed if self.elapsed > 0 else 0
+        print("[+] Wrote {0} notes ({1:.1f} KB) in {2:.2f}s - {3:.0f} notes/sec".format(
+            self.notes_written, self.bytes_written / 1024, self.elapsed, rate))
+        if self.errors != 0:
+            print("[!] {0} notes could not be written, see the errors above.".format(self.errors))
 
+    def _submit(self, func, *args):
+        self.queued.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.queued.release()
+            raise
 
+        file_name = args[1]
+        with self.lock:
+            self.pending[future] = file_name
+            self.pending_names[file_name] = self.pending_names.get(file_name, 0) + 1
+        future.add_done_callback(self._done)
 
-def main():
-    parser = argparse.ArgumentParser(description="A program to quickly set up notes for an operation.")
-    subparsers = parser.add_subparsers(dest="command")
+    def _done(self, future):
+        with self.lock:
+            file_name = self.pending.pop(future)
+            self.pending_names[file_name] -= 1
+            if self.pending_names[file_name] == 0:
+                del self.pending_names[file_name]
+        self.queued.release()
 
-    # Assessment init
-    parser_init = subparsers.add_parser( "init", help="Initialize an assessment folder or vault at the target location")
-    parser_init.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the folder where you "
-                    + "want the folder or vault created. "
-                    + "NOTE 1: If you already have a vault, give the vault folder path to put this in the root of the vault, "
-                    + "or designate one of the subfolders you have (e.g. vault/assessments). "
-                    + "NOTE 2: This will NOT create a templates folder, presuming you already have one. Add "
-                    + "--template if you'd like a template folder placed in the operation folder to copy out.")
-    parser_init.add_argument("-n", "--name", required=True, help="REQUIRED - The operation codename.")
-    parser_init.add_argument("-t", "--type", required=True, help="REQUIRED - The operation type: internal or external",
-                             choices=["internal", "external"], type=str.lower)
-    parser_init.add_argument("--vault", help="Creates an entire vault rather than a simple folder, using the op name for the "
-                    + "vault folder name. Will create the op folder and 01-Templates. Set your Obsidian settings to use "
-                    + "01-Templates as the template folder. Optional: replace the provided templates/obsidian folder in "
-                    + "this project with your with your own Obsidian settings. You will need at least the DataView "
-                    + "plugin installed and add the contents of types.json.",
-                    action="store_true")
-    parser_init.add_argument("--reusable", help="Use with --vault to create a vault structure to support multiple ops. Will "
-                    + "instead name the vault AssessmentNotes and create a sub-folder for the designated op. Other ops can "
-                    + "then be added by not supplying --vault in the future.", action="store_true")
-    parser_init.add_argument("--template", help="Creates a template folder in the operation folder without creating the "
-                    + "whole vault.", action="store_true")
+    def _record(self, bytes_written):
+        with self.lock:
+            if bytes_written is None:
+                self.errors += 1
+            elif bytes_written > 0:
+                self.notes_written += 1
+                self.bytes_written += bytes_written
 
-    # Host parse
-    parser_parse = subparsers.add_parser("parse", help="Parse a supplied gnmap or host list into Obsidian notes. Requires an "
-                    + "initialized op folder using the init command.")
-    parser_parse.add_argument("-f", "--folder", help="The full path to the operation folder. Expects that the folder has "
-                    + "been initialized already using the init command.", required=True)
-    parser_parse.add_argument("-n", "--name", required=True, help="REQUIRED - The operation codename.")
-    parser_parse.add_argument("-t", "--type", required=True, help="REQUIRED - The operation type: internal or external",
-                             choices=["internal", "external"], type=str.lower)
-    parser_parse.add_argument("-l", "--host-list", help="Path to the list of hosts, one per line. If you plan to use "
-                    + "a gnmap file, you should use -g and -m together instead of this option.")
-    parser_parse.add_argument("-g", "--gnmap", help="Path to the gnmap file to parse. Creates an Obsidian note per entry "
-                    + "using the IP address and reverse DNS name if available. Combine with -m to pair host name with IP.")
-    parser_parse.add_argument("-m", "--host-map", help="Path to a map file of format: host,ip with each host on a new line. "
-                    + "Used to add host names to file names instead of just IPs when parsing a gnmap file.")
+    def _write(self, path, file_name, text):
+        file_path = os.path.join(path, file_name)
+        try:
+            with stats_phase("write"):
+                bytes_written = write_text_atomic(file_path, text)
+            self._record(bytes_written)
+        except Exception as e:
+            print("Error writing to file: {0}.\n\nError: {1}".format(file_path, e))
+            self._record(None)
 
+    def _merge(self, path, file_name, host_data):
+        with stats_phase("write"):
+            bytes_written = merge_host_file(path, file_name, host_data)
+        self._record(bytes_written)
 
-    args = parser.parse_args()
 
-    if args.command == "parse":
+#               #
+# Asset section #
+#               #
+# Every vault gets the same few MB of plugins and settings. Each file is stored once in the asset store under the
+# sha256 of its contents and cloned from there: a reflink (copy-on-write, nothing shared once either side changes)
+# where the filesystem supports it, otherwise a hardlink for the plugin files, otherwise a plain copy.
+# A hardlinked file edited in place changes the stored copy too, so stored files are re-hashed before first use
+# in a run and replaced if they no longer match. Updating a file in templates/ simply gives it a new entry
+
+ASSET_HASHES = {}
+VERIFIED_ASSETS = set()
+
+def get_asset_store():
+    if ASSET_STORE_PATH is not None:
+        return ASSET_STORE_PATH
+
+    return os.path.join(get_template_directory(), ".assets")
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+def store_asset(source_path):
+    """
+    Adds a file to the asset store if needed and returns its path in the store
+    """
+    stat = os.stat(source_path)
+    key = (source_path, stat.st_mtime_ns, stat.st_size)
+    if key not in ASSET_HASHES:
+        ASSET_HASHES[key] = hash_file(source_path)
+    file_hash = ASSET_HASHES[key]
+
+    store_path = os.path.join(get_asset_store(), file_hash[:2], file_hash)
+    if store_path in VERIFIED_ASSETS:
+        return store_path
+
+    if not os.path.exists(store_path) or hash_file(store_path) != file_hash:
+        create_directory(os.path.dirname(store_path), True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(store_path), suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(source_path, temp_path)
+            set_file_mode(temp_path, store_path)
+            os.replace(temp_path, store_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    # Files stored by older versions were only readable by their owner, and vaults hardlink straight to them
+    mode = 0o666 & ~UMASK
+    if os.stat(store_path).st_mode & 0o777 != mode:
+        os.chmod(store_path, mode)
+
+    VERIFIED_ASSETS.add(store_path)
+
+    return store_path
+
+def reflink_file(source_path, dest_path):
+    """
+    Clones a file with the FICLONE ioctl. Returns False if the filesystem (or OS) can't
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        with open(source_path, "rb") as source, open(dest_path, "wb") as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+    except OSError:
+        try:
+            os.remove(dest_path)
+        except OSError:
+            pass
+        return False
+
+    shutil.copystat(source_path, dest_path)
+
+    return True
+
+def link_asset(source_path, dest_path, shareable=False):
+    """
+    Puts a copy of source_path at dest_path, sharing storage with the asset store where possible.
+    Only shareable files may be hardlinked
+    """
+    # Never write through an existing file, it may be a hardlink into the store
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+
+    store_path = None
+    if ASSET_LINK != "copy":
+        try:
+            store_path = store_asset(source_path)
+        except Exception as e:
+            print("[!] Couldn't use the asset store ({0}), copying instead. Error: {1}".format(get_asset_store(), e))
+
+    if store_path is not None:
+        if ASSET_LINK in ["auto", "reflink"] and reflink_file(store_path, dest_path):
+            stats_count("assets_reflinked")
+            return
+
+        if ASSET_LINK in ["auto", "hardlink"] and shareable:
+            try:
+                os.link(store_path, dest_path)
+                stats_count("assets_hardlinked")
+                return
+            except OSError:
+                pass
+
+    shutil.copy(source_path, dest_path)
+    stats_count("assets_copied")
+
+
+#                #
+# Layout section #
+#                #
+# With the subnet/domain layouts, notes go in Content/<shard>/ and every shard gets an "Index - <shard>.md" note
+# linking its hosts. Obsidian resolves links by note name, so the Tracker links and DataView queries work the
+# same no matter which folder a note is in. Note paths (relative to Content) are used everywhere a file name was
+
+def get_layout_path(folder_path):
+    return os.path.join(folder_path, LAYOUT_NAME)
+
+def load_layout(folder_path):
+    global LAYOUT
+    global ALIAS_NOTES
+    LAYOUT = "flat"
+    ALIAS_NOTES = False
+
+    # The file holds the layout, followed by "aliases" if the op uses --aliases
+    try:
+        with open(get_layout_path(folder_path), "r") as f:
+            words = f.read().split()
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print("[!] Error reading the op's layout, using the flat layout. Error: {0}".format(e))
+        return
+
+    layout = words[0] if len(words) != 0 else "flat"
+    ALIAS_NOTES = "aliases" in words[1:]
+    if layout in LAYOUTS:
+        LAYOUT = layout
+    else:
+        print("[!] Unknown layout {0} in {1}, using the flat layout.".format(layout, get_layout_path(folder_path)))
+
+def save_layout(folder_path, layout, aliases=False):
+    try:
+        write_text_atomic(get_layout_path(folder_path), layout + (" aliases" if aliases else "") + "\n")
+    except Exception as e:
+        print("[!] Error saving the op's layout. Error: {0}".format(e))
+
+def get_registered_domain(name):
+    """
+    Returns the registered domain of a host name, e.g. client.com for www.dev.client.com
+    """
+    labels = normalize_host_name(name).split(".")
+    if len(labels) < 2:
+        return ""
+
+    if ".".join(labels[-2:]) in SECOND_LEVEL_SUFFIXES and len(labels) >= 3:
+        return ".".join(labels[-3:])
+
+    return ".".join(labels[-2:])
+
+def get_shard(host, domain=""):
+    """
+    Returns the shard folder name for a note. host is the IP (or host list entry) and domain
+    the name the note is filed under, if any
+    """
+    if LAYOUT == "subnet":
+        if not is_ip(host):
+            return "Unresolved"
+        return get_note_host(get_subnet(host)).replace("/", "_")
+
+    registered_domain = get_registered_domain(domain) if domain not in ["", "()"] else ""
+
+    return registered_domain if registered_domain != "" else "No Domain"
+
+def get_note_path(host, file_name, domain=""):
+    if LAYOUT == "flat":
+        return file_name
+
+    return os.path.join(get_shard(host, domain), file_name)
+
+def create_shard_folder(content_folder, file_name):
+    shard = os.path.dirname(file_name)
+    if shard == "" or shard in SHARDS_TOUCHED:
+        return
+
+    create_directory(os.path.join(content_folder, shard))
+    SHARDS_TOUCHED.add(shard)
+
+def is_shard_index(file_name):
+    return os.path.basename(file_name).startswith(SHARD_INDEX_PREFIX)
+
+def iter_note_files(content_folder):
+    """
+    Yields the (path relative to Content, full path) of every host note, in Content and in shard folders
+    """
+    for entry in os.scandir(content_folder):
+        if entry.is_dir():
+            for sub_entry in os.scandir(entry.path):
+                if sub_entry.is_file() and sub_entry.name.endswith(".md") and not is_shard_index(sub_entry.name):
+                    yield os.path.join(entry.name, sub_entry.name), sub_entry.path
+        elif entry.is_file() and entry.name.endswith(".md"):
+            yield entry.name, entry.path
+
+def render_shard_index(shard, note_names):
+    title = shard.replace("_", "/") if LAYOUT == "subnet" else shard
+    lines = ["# " + title, "*Generated by vault-generator.py. Rewritten whenever hosts are added to this folder.*",
+             "", "Hosts ({0}):".format(len(note_names))]
+    lines += ["- [[" + name + "]]" for name in note_names]
+
+    return "\n".join(lines) + "\n"
+
+def write_shard_indexes(content_folder):
+    """
+    Regenerates the index note of every shard written to since the last call.
+    Index notes are only rewritten when their host list changed
+    """
+    for shard in sorted(SHARDS_TOUCHED):
+        shard_folder = os.path.join(content_folder, shard)
+        note_names = sorted(entry.name[:-3] for entry in os.scandir(shard_folder)
+                            if entry.is_file() and entry.name.endswith(".md") and not is_shard_index(entry.name))
+
+        index_path = os.path.join(shard_folder, SHARD_INDEX_PREFIX + shard + ".md")
+        text = render_shard_index(shard, note_names)
+        try:
+            with open(index_path, "r") as f:
+                if f.read() == text:
+                    continue
+        except FileNotFoundError:
+            pass
+
+        try:
+            write_text_atomic(index_path, text)
+            stats_count("shard_indexes_written")
+        except Exception as e:
+            print("Error writing to file: {0}.\n\nError: {1}".format(index_path, e))
+
+    SHARDS_TOUCHED.clear()
+
+
+#               #
+# Alias section #
+#               #
+# With --aliases, parse writes one note per IP named "ip (rdns).md" and lists the IP's domains in its aliases
+# frontmatter, so Obsidian still finds the note by any of them. collapse switches an op that already has a note
+# per domain over: the notes for each IP are merged into that one note and links to the old names are rewritten
+
+def get_note_domain(file_name):
+    # "domain - (ip) (rdns).md" -> domain, "" for notes named by IP
+    name = os.path.basename(file_name)
+
+    return name.split(" - (")[0] if " - (" in name else ""
+
+def get_note_rdns(file_name):
+    # The "(rdns)" part of a host note name, "()" if it has none
+    name = os.path.basename(file_name)[:-3]
+    note_host = get_note_host(get_note_ip(file_name))
+    if " - (" in name:
+        rest = name.split("(" + note_host + ")", 1)[-1]
+    else:
+        rest = name[len(note_host):]
+    rest = rest.strip()
+
+    return rest if rest.startswith("(") and rest.endswith(")") else "()"
+
+def get_frontmatter_end(contents):
+    # Index of the closing --- of the frontmatter, None if the note has none
+    if len(contents) == 0 or contents[0].strip() != "---":
+        return None
+
+    for i, line in enumerate(contents[1:], start=1):
+        if line.strip() == "---":
+            return i
+
+    return None
+
+def get_frontmatter_value(contents, field_name):
+    end = get_frontmatter_end(contents)
+    for line in contents[1:end or 0]:
+        if line.startswith(field_name + ":"):
+            return line[len(field_name) + 1:].strip()
+
+    return None
+
+def set_frontmatter_value(contents, field_name, value):
+    end = get_frontmatter_end(contents)
+    for i in range(1, end or 0):
+        if contents[i].startswith(field_name + ":"):
+            contents[i] = field_name + ": " + value
+            break
+
+    return contents
+
+def merge_note_contents(content_folder, notes, aliases):
+    """
+    Merges several notes for the same host into the lines of one note, based on the first.
+    Frontmatter lists are unioned, values only set in the other notes (followUp: true, etc.)
+    are kept, and lines of note text the first note doesn't have are added under a heading
+    """
+    merged = get_file_contents(os.path.join(content_folder, notes[0]))
+    end = get_frontmatter_end(merged)
+    if end is None:
+        merged = ["---", "---"] + merged
+        end = 1
+    if not any(line.startswith("aliases:") for line in merged[1:end]):
+        merged.insert(1, "aliases:")
+        end += 1
+    body_lines = set(merged[end + 1:])
+
+    for note in notes[1:]:
+        note_path = os.path.join(content_folder, note)
+        for field_name, value in read_frontmatter(note_path).items():
+            if isinstance(value, list) or field_name in TEMPLATE_LIST_FIELDS:
+                merged = merge_frontmatter(merged, as_list(value), field_name)
+            elif get_frontmatter_value(merged, field_name) in ["", "false"] and value not in ["", "false"]:
+                merged = set_frontmatter_value(merged, field_name, value)
+
+        # Notes straight from the template add nothing, only what was written in them is carried over
+        contents = get_file_contents(note_path)
+        note_end = get_frontmatter_end(contents)
+        added = [line for line in contents[note_end + 1 if note_end is not None else 0:] if line not in body_lines]
+        if "\n".join(added).strip() != "":
+            body_lines.update(added)
+            merged += ["", "# Merged from " + os.path.basename(note)[:-3], ""] + added
+
+    return merge_frontmatter(merged, aliases, "aliases")
+
+def rewrite_note_links(folder_path, renames):
+    """
+    Points [[links]] to renamed notes at the new note in every note in the op folder,
+    keeping the old name as the link text
+    """
+    link_regex = re.compile(r"\[\[([^\]|#\n]+)(#[^\]|\n]*)?(\|[^\]\n]*)?\]\]")
+
+    def replace(match):
+        name = match.group(1)
+        if name not in renames:
+            return match.group(0)
+
+        return "[[" + renames[name] + (match.group(2) or "") + (match.group(3) or "|" + name) + "]]"
+
+    rewritten = 0
+    for root, dirs, files in os.walk(folder_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for file_name in files:
+            if not file_name.endswith(".md"):
+                continue
+
+            file_path = os.path.join(root, file_name)
+            try:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    text = f.read()
+                new_text = link_regex.sub(replace, text)
+                if new_text != text:
+                    write_text_atomic(file_path, new_text)
+                    rewritten += 1
+            except Exception as e:
+                print("[!] Error updating links in {0}. Error: {1}".format(file_path, e))
+
+    return rewritten
+
+def handle_collapse(folder_path):
+    global ALIAS_NOTES
+    start_time = time.perf_counter()
+    content_folder = os.path.join(folder_path, "Content")
+    conn = open_index(folder_path)
+    load_manifest(conn, folder_path)
+    load_layout(folder_path)
+    ALIAS_NOTES = True
+
+    hosts = {}
+    for note, note_path in iter_note_files(content_folder):
+        ip = get_note_ip(note)
+        if ip != "":
+            hosts.setdefault(ip, []).append(note)
+
+    renames = {}
+    collapsed = 0
+    emptied_shards = set()
+    for ip, notes in hosts.items():
+        notes.sort()
+        domains = []
+        for note in notes:
+            domain = get_note_domain(note)
+            if domain != "" and domain not in domains:
+                domains.append(domain)
+
+        rdns_names = [get_note_rdns(note) for note in notes if get_note_rdns(note) != "()"]
+        rdns = rdns_names[0] if len(rdns_names) != 0 else "()"
+        canonical = get_host_file_names(ip, {"rdns": rdns, "domains": domains})[0]
+        if notes == [canonical]:
+            continue
+
+        # An existing note with the new name is the one the others are merged into
+        notes.sort(key=lambda note: note != canonical)
+        try:
+            contents = merge_note_contents(content_folder, notes, domains)
+            create_shard_folder(content_folder, canonical)
+            write_text_atomic(os.path.join(content_folder, canonical), "\n".join(contents) + "\n")
+        except Exception as e:
+            print("[!] Error collapsing the notes for {0}. Error: {1}".format(ip, e))
+            continue
+
+        for note in notes:
+            if note == canonical:
+                continue
+            os.remove(os.path.join(content_folder, note))
+            update_manifest(conn, note, None)
+            renames[os.path.basename(note)[:-3]] = os.path.basename(canonical)[:-3]
+            if os.path.dirname(note) != "":
+                emptied_shards.add(os.path.dirname(note))
+            collapsed += 1
+
+        # Forces the next --incremental parse to merge into the note instead of skipping it
+        update_manifest(conn, canonical, "")
+
+    # Shards left without notes (e.g. per-domain folders in the domain layout) are removed with their index
+    for shard in emptied_shards:
+        shard_folder = os.path.join(content_folder, shard)
+        if any(True for entry in os.scandir(shard_folder) if not is_shard_index(entry.name)):
+            SHARDS_TOUCHED.add(shard)
+            continue
+        shutil.rmtree(shard_folder)
+        SHARDS_TOUCHED.discard(shard)
+
+    write_shard_indexes(content_folder)
+    rewritten = rewrite_note_links(folder_path, renames)
+    save_manifest(conn)
+    conn.commit()
+    conn.close()
+    save_layout(folder_path, LAYOUT, True)
+
+    print("[+] Collapsed {0} notes into {1} notes with aliases and updated links in {2} notes in {3:.2f}s".format(
+        collapsed, len(set(renames.values())), rewritten, time.perf_counter() - start_time))
+    handle_index(folder_path)
+
+
+#                 #
+# Journal section #
+#                 #
+# parse appends a checkpoint per input to the journal every JOURNAL_INTERVAL hosts: how many records of that input
+# are done and, for gnmap, the byte offset to continue from. A checkpoint is only written after the notes before it
+# are on disk and saved to the manifest and index. The journal is removed when a parse finishes, so one left behind
+# means the last parse was interrupted, and --resume continues it from the last checkpoint
+
+class Journal:
+    """
+    Append-only log of parse checkpoints for an op folder
+    """
+    def __init__(self, folder_path, fingerprint, resume=False):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, JOURNAL_NAME)
+        self.states = {}
+        # {host key:reverse DNS} of the hosts written before the checkpoints, see PARSED_HOSTS
+        self.seen = {}
+
+        if resume:
+            self._load(fingerprint)
+        elif os.path.exists(self.path):
+            print("[*] The last parse of this op didn't finish. Starting over, use --resume to continue it instead.")
+
+        if len(self.states) == 0:
+            with open(self.path, "w") as f:
+                f.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+
+        self.file = open(self.path, "a")
+
+    def _load(self, fingerprint):
+        try:
+            with open(self.path, "r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            print("[*] Nothing to resume, the last parse of this op finished. Parsing from the beginning.")
+            return
+
+        # A checkpoint cut off by a crash is ignored, the one before it still holds
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+
+        if len(entries) == 0 or entries[0].get("fingerprint") != fingerprint:
+            print("Error: The inputs or options don't match the interrupted parse, so it can't be resumed. Run it "
+                  "with the same arguments, or without --resume to start over.")
+            sys.exit(1)
+
+        for entry in entries[1:]:
+            self.seen.update(entry.pop("seen", []))
+            self.states[entry["input"]] = entry
+
+        for input_name, state in self.states.items():
+            print("[*] Resuming {0} after {1} hosts{2}".format(input_name, state["records"],
+                                                                  " (done)" if state.get("done") else ""))
+
+    def get(self, input_name):
+        return self.states.get(input_name, {})
+
+    def pop_seen(self):
+        seen = self.seen
+        self.seen = {}
+
+        return seen
+
+    def checkpoint(self, input_name, records, position=None, done=False, seen=None):
+        # Everything up to this record has to be on disk before the checkpoint says so
+        WRITER.flush()
+        save_manifest(INDEX)
+        flush_index(INDEX)
+        INDEX.commit()
+
+        entry = {"input": input_name, "records": records, "done": done}
+        if position is not None:
+            entry["offset"] = position["offset"]
+
+        line = json.dumps(entry if seen is None else dict(entry, seen=seen)) + "\n"
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.states[input_name] = entry
+        stats_count("checkpoints")
+
+    def close(self, finished):
+        self.file.close()
+        if finished:
+            os.remove(self.path)
+
+def handle_interrupt(signum, frame):
+    global INTERRUPTED
+
+    # A second Ctrl-C stops right away, the last checkpoint still holds
+    if INTERRUPTED:
+        raise KeyboardInterrupt
+
+    INTERRUPTED = True
+    print("\n[*] Stopping after the current host. Press Ctrl-C again to stop right away.")
+
+def get_parse_fingerprint(paths, options):
+    """
+    Identifies a parse by its input files (path, size, modification time) and options
+    """
+    inputs = []
+    for path in paths:
+        if path is None:
+            inputs.append(None)
+            continue
+        stat = os.stat(path)
+        inputs.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha1(json.dumps([inputs, options], sort_keys=True).encode()).hexdigest()
+
+def iter_journaled(input_name, records, position=None, on_skip=None, size=None, seen=None):
+    """
+    Passes an input's records through, checkpointing every JOURNAL_INTERVAL hosts.
+    When resuming, records that were already written are skipped (on_skip is called for each).
+    If a position is supplied, the records were read starting from the checkpoint's offset so
+    nothing needs skipping. Records are one host each unless size is supplied to count them (batches)
+    If a seen list is supplied, its contents are saved with the next checkpoint and it's emptied
+    so a resumed parse knows which hosts already have notes, even if it skips the inputs they were in
+    """
+    if JOURNAL is None:
+        yield from records
+        return
+
+    state = JOURNAL.get(input_name)
+    if state.get("done"):
+        return
+
+    done = state.get("records", 0)
+    count = done if position is not None else 0
+    last_checkpoint = count
+    for record in records:
+        hosts = 1 if size is None else size(record)
+        count += hosts
+        if count <= done:
+            if on_skip is not None:
+                on_skip(record)
+            stats_count("records_resumed", hosts)
+            continue
+
+        yield record
+
+        # The consumer asking for the next record means this one has been handed to the writer
+        if INTERRUPTED or count - last_checkpoint >= JOURNAL_INTERVAL:
+            JOURNAL.checkpoint(input_name, count, position, seen=seen[:] if seen is not None else None)
+            last_checkpoint = count
+            if seen is not None:
+                seen.clear()
+        if INTERRUPTED:
+            raise KeyboardInterrupt
+
+    JOURNAL.checkpoint(input_name, count, position, True, seen=seen)
+
+
+#                    #
+# Incremental section #
+#                    #
+def get_manifest_path(folder_path):
+    return os.path.join(folder_path, MANIFEST_NAME)
+
+def load_manifest(conn, folder_path):
+    """
+    Moves a manifest file left by an earlier version into the index
+    """
+    MANIFEST_CHANGES.clear()
+    manifest_path = get_manifest_path(folder_path)
+
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r") as f:
+                conn.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?)", json.load(f).items())
+            conn.commit()
+            os.remove(manifest_path)
+        except Exception as e:
+            conn.rollback()
+            print("[!] Error reading the note manifest, all notes will be treated as changed. Error: {0}".format(e))
+
+def get_manifest_hash(conn, file_name):
+    if file_name in MANIFEST_CHANGES:
+        return MANIFEST_CHANGES[file_name]
+
+    row = conn.execute("SELECT hash FROM manifest WHERE note = ?", (file_name,)).fetchone()
+
+    return row[0] if row is not None else None
+
+def has_manifest_notes(conn):
+    if any(data_hash is not None for data_hash in MANIFEST_CHANGES.values()):
+        return True
+
+    return conn.execute("SELECT EXISTS (SELECT 1 FROM manifest)").fetchone()[0] == 1
+
+def update_manifest(conn, file_name, data_hash):
+    """
+    Records the hash for a note, or that it was removed if data_hash is None
+    """
+    MANIFEST_CHANGES[file_name] = data_hash
+
+    if len(MANIFEST_CHANGES) >= MANIFEST_BATCH_SIZE:
+        save_manifest(conn)
+
+def save_manifest(conn):
+    """
+    Writes the manifest entries changed since the last save to the index. The caller commits
+    """
+    if len(MANIFEST_CHANGES) == 0:
+        return
+
+    with stats_phase("index"):
+        conn.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?)",
+                         [(note, data_hash) for note, data_hash in MANIFEST_CHANGES.items() if data_hash is not None])
+        conn.executemany("DELETE FROM manifest WHERE note = ?",
+                         [(note,) for note, data_hash in MANIFEST_CHANGES.items() if data_hash is None])
+
+    MANIFEST_CHANGES.clear()
+
+def hash_host_data(host_data):
+    # Only the scan data that ends up in the frontmatter matters, the file name covers the rest
+    data = [host_data[key] for key in HOST_LIST_FIELDS.values()]
+    if ALIAS_NOTES:
+        data.append(host_data["domains"])
+    data = json.dumps(data)
+
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def is_note_current(content_folder, file_name, data_hash):
+    if get_manifest_hash(INDEX, file_name) != data_hash:
+        return False
+
+    return os.path.exists(os.path.join(content_folder, file_name))
+
+def merge_host_file(content_folder, file_name, host_data):
+    """
+    Adds any new ports/services to the frontmatter of an existing note
+    without touching the rest of the note
+    Returns the number of bytes written (0 if nothing changed) or None on error
+    """
+    file_path = os.path.join(content_folder, file_name)
+    try:
+        # Read without newline translation so the note keeps its own line endings
+        with open(file_path, "r", newline="") as f:
+            text = f.read()
+    except Exception as e:
+        print("[!] Error reading existing note {0}. Error: {1}".format(file_name, e))
+        return None
+
+    newline = "\r\n" if "\r\n" in text else "\n"
+    contents = text.splitlines()
+
+    merged = contents
+    for field_name, key in HOST_LIST_FIELDS.items():
+        merged = merge_frontmatter(merged, host_data[key], field_name)
+    if ALIAS_NOTES:
+        merged = merge_frontmatter(merged, host_data["domains"], "aliases")
+
+    if merged == contents:
+        return 0
+
+    try:
+        return write_text_atomic(file_path, newline.join(merged) + (newline if text.endswith("\n") else ""))
+    except Exception as e:
+        print("Error writing to file: {0}.\n\nError: {1}".format(file_path, e))
+        return None
+
+def merge_frontmatter(contents, data, field_name):
+    """
+    Takes a list of data and inserts the items that aren't already listed
+    under the designated field name in the frontmatter of existing note contents.
+    """
+    spacer = "  - "
+    insert_index = None
+    existing = []
+    existing_raw = []
+
+    # Only look inside the frontmatter block so the body is never touched
+    if len(contents) == 0 or contents[0].strip() != "---":
+        return contents
+
+    for i,line in enumerate(contents[1:], start=1):
+        if line.strip() == "---":
+            break
+
+        if insert_index is None:
+            if line.startswith(field_name + ":"):
+                insert_index = i + 1
+            continue
+
+        if not line.startswith(spacer):
+            break
+
+        existing_raw.append(line[len(spacer):].strip())
+        existing.append(existing_raw[-1].strip("\"'"))
+        insert_index = i + 1
+
+    if insert_index is None:
+        return contents
+
+    data_yaml = [spacer + yaml_quote(item) for item in data
+                 if item not in existing and yaml_quote(item) not in existing_raw]
+    if len(data_yaml) == 0:
+        return contents
+
+    new_contents = contents[:]
+    new_contents[insert_index:insert_index] = data_yaml
+
+    return new_contents
+
+
+def new_host(rdns="", domains=None):
+    """
+    Returns an empty host_data dict
+    """
+    if domains is None:
+        domains = []
+
+    return {"rdns": rdns, "domains": domains, "ports": [], "services": [], "versions": [], "scripts": []}
+
+
+def filter_gnmap_lines(lines):
+    """
+    Passes through only the gnmap lines that have open ports to parse
+    """
+    skipped = 0
+    try:
+        for line in lines:
+            if "/open/" in line.lower():
+                yield line
+            else:
+                skipped += 1
+    finally:
+        stats_count("lines_skipped", skipped)
+
+def parse_gnmap_line(line):
+    """
+    Parses a single gnmap "Ports:" line into (ip, host entry)
+    Returns None if the line can't be parsed
+    """
+    # Get the sections of the gnmap that are useful as arrays
+    sections = line.split('\t')
+    if len(sections) < 2:
+        return None
+
+    host_info = sections[0].split(' ')
+    ports_info = sections[1][7:].split(', ')
+
+    if len(host_info) < 3:
+        return None
+
+    # Get the IP and rdns (if available)
+    ip = host_info[1]
+    rdns = host_info[2]
+
+    # Loop over the port strings and add # and services
+    host_data = new_host(rdns)
+    for port in ports_info:
+
+        if not "/open/" in port.lower():
+            continue
+
+        try:
+            port_num, state, proto, owner, service, rpc, version, empty = port.split("/")
+        except ValueError:
+            continue
+
+        host_data["ports"].append(port_num)
+
+        if service != "" and not service in host_data["services"]:
+            host_data["services"].append(service)
+
+        if version != "":
+            host_data["versions"].append(port_num + "/" + service + ": " + version)
+
+    return ip, host_data
+
+def iter_gnmap_hosts(gnmap_path, position=None):
+    """
+    Generator pipeline over a gnmap file: read -> filter -> parse
+    Yields (ip, host entry) one line at a time so memory use stays flat
+    regardless of the size of the scan
+    With a position dict, reading starts at position["offset"] and it's kept updated
+    """
+    offset = position["offset"] if position is not None else 0
+    for line in filter_gnmap_lines(read_lines(gnmap_path, offset, position)):
+        with stats_phase("parse"):
+            record = parse_gnmap_line(line)
+        if record is not None:
+            yield record
+
+def parse_gnmap(gnmap_path, hosts=None):
+    """
+    Loads every host in a gnmap file into a HostStore (a new one if not supplied) and returns it
+    """
+    if hosts is None:
+        hosts = HostStore()
+
+    try:
+        for ip, host_data in iter_gnmap_hosts(gnmap_path):
+            hosts.merge(ip, host_data)
+    except Exception as e:
+        print("[!] Error fetching contents of gnmap file. Error: {0}".format(e))
+
+    return hosts
+
+def get_scan_extension(file_name):
+    """
+    Returns the lowercase extension of a scan file, skipping a compression extension after it
+    """
+    root, extension = os.path.splitext(file_name.lower())
+    if extension in COMPRESSED_EXTENSIONS:
+        extension = os.path.splitext(root)[1]
+
+    return extension
+
+def get_gnmap_files(paths):
+    """
+    Expands the supplied gnmap files, folders and glob patterns into a sorted list of
+    gnmap files with no repeats. Takes a single path or a list of them
+    """
+    if paths is None:
+        return []
+    if isinstance(paths, str):
+        paths = [paths]
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = [entry.path for entry in os.scandir(path)
+                       if entry.is_file() and get_scan_extension(entry.name) in GNMAP_EXTENSIONS]
+        elif any(char in path for char in "*?["):
+            matches = [match for match in glob.glob(path, recursive=True) if os.path.isfile(match)]
+        elif os.path.isfile(path):
+            matches = [path]
+        else:
+            print("[!] The supplied gnmap file could not be found: {0}".format(path))
+            continue
+
+        files.extend(os.path.abspath(match) for match in matches)
+
+    return sorted(set(files))
+
+def parse_gnmap_files(gnmap_paths, processes=None):
+    """
+    Parses gnmap files in a process pool and merges them into one HostStore. Ports, services, etc.
+    are merged as ordered set unions, and files are merged in the order given no matter which
+    finishes first, so the same inputs always give the same notes
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    hosts = HostStore()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(min(processes, len(gnmap_paths)), 1)) as executor:
+        for path, file_hosts in zip(gnmap_paths, executor.map(parse_gnmap, gnmap_paths)):
+            print("[*] Parsed {0} hosts from {1}".format(len(file_hosts), path))
+            hosts.update(file_hosts)
+            stats_count("gnmap_files")
+
+    return hosts
+
+def stream_host_notes(folder_path, op_name, op_type, records, correlator=None, input_name=None, position=None):
+    """
+    Writes a host note for each (ip, host entry) record as soon as it has been parsed
+    instead of collecting every host in a HostStore first. correlator is an optional
+    HostCorrelator used to add names from the host list/map
+    input_name/position are passed on to iter_journaled
+    """
+    content_folder = os.path.join(folder_path, "Content")
+    template = get_host_template(op_type)
+    new_hosts = [] if JOURNAL is not None else None
+
+    # Hosts skipped on --resume still need to be matched so the host list doesn't get notes for them again
+    def on_skip(record):
+        PARSED_HOSTS.setdefault(host_key(record[0]), record[1]["rdns"])
+        if correlator is not None:
+            correlator.correlate(*record)
+
+    if input_name is not None:
+        records = iter_journaled(input_name, records, position, on_skip, seen=new_hosts)
+
+    # Earlier inputs' notes have to be on disk before this one merges into them
+    WRITER.flush()
+    for ip, host_data in records:
+        write_streamed_host(content_folder, template, op_name, ip, host_data, correlator, new_hosts)
+
+def write_streamed_host(content_folder, template, op_name, ip, host_data, correlator=None, new_hosts=None):
+    """
+    Writes the note for a scanned host, or merges it into the note an earlier record or input
+    wrote for it (see PARSED_HOSTS). Hosts written for the first time are added to new_hosts
+    """
+    key = host_key(ip)
+    rdns = PARSED_HOSTS.get(key)
+    merge = rdns is not None
+    # Scans can disagree on the reverse DNS name, which would give the host a second note
+    if merge:
+        host_data["rdns"] = rdns
+
+    if correlator is not None:
+        host_data = correlator.correlate(ip, host_data)
+    if SCOPE is not None and not SCOPE.check(ip, host_data):
+        return
+
+    if not merge:
+        # Every parsed host has its own copy of "()", one shared copy is enough for the ones without a name
+        rdns = host_data["rdns"]
+        PARSED_HOSTS[key] = "()" if rdns == "()" else rdns
+        if new_hosts is not None:
+            new_hosts.append([key, rdns])
+        stats_count("hosts")
+    write_host_note(content_folder, template, op_name, ip, host_data, merge)
+
+def stream_gnmap_notes(folder_path, op_name, op_type, gnmap_path, correlator=None):
+    try:
+        # A resumed parse can seek straight to the checkpoint, unless skipped hosts need matching to the host list
+        position = None
+        if JOURNAL is not None and (correlator is None or len(correlator.listed_names) == 0):
+            position = {"offset": JOURNAL.get("gnmap").get("offset", 0)}
+
+        records = iter_gnmap_hosts(gnmap_path, position)
+        stream_host_notes(folder_path, op_name, op_type, records, correlator, "gnmap", position)
+    except Exception as e:
+        print("[!] Error fetching contents of gnmap file. Error: {0}".format(e))
+        return
+
+
+def get_nmap_xml_version(service):
+    """
+    Builds a version string from the product/version/extrainfo of an nmap <service>
+    """
+    version_parts = [service.get(attr, "") for attr in ["product", "version", "extrainfo"]]
+
+    return " ".join(part for part in version_parts if part != "")
+
+def get_nmap_xml_script(prefix, script):
+    output = " ".join(script.get("output", "").split())
+    if len(output) > SCRIPT_OUTPUT_LIMIT:
+        output = output[:SCRIPT_OUTPUT_LIMIT] + "..."
+
+    return prefix + script.get("id", "") + ": " + output
+
+def parse_nmap_xml_host(host):
+    """
+    Parses a single nmap <host> element into (ip, host entry)
+    Returns None if the host is down or has no open ports
+    """
+    status = host.find("status")
+    if status is not None and status.get("state") != "up":
+        return None
+
+    ip = None
+    for address in host.findall("address"):
+        if address.get("addrtype") in ["ipv4", "ipv6"]:
+            ip = address.get("addr")
+            break
+
+    if ip is None:
+        return None
+
+    # Match the gnmap format of (rdns) or ()
+    rdns = "()"
+    for hostname in host.findall("hostnames/hostname"):
+        if hostname.get("type") == "PTR":
+            rdns = "(" + hostname.get("name", "") + ")"
+            break
+
+    host_data = new_host(rdns)
+    for port in host.findall("ports/port"):
+        state = port.find("state")
+        if state is None or state.get("state") != "open":
+            continue
+
+        port_num = port.get("portid", "")
+        host_data["ports"].append(port_num)
+
+        service_name = ""
+        service = port.find("service")
+        if service is not None:
+            service_name = service.get("name", "")
+            version = get_nmap_xml_version(service)
+
+            if service_name != "" and not service_name in host_data["services"]:
+                host_data["services"].append(service_name)
+            if version != "":
+                host_data["versions"].append(port_num + "/" + service_name + ": " + version)
+
+        for script in port.findall("script"):
+            host_data["scripts"].append(get_nmap_xml_script(port_num + "/", script))
+
+    if len(host_data["ports"]) == 0:
+        return None
+
+    for script in host.findall("hostscript/script"):
+        host_data["scripts"].append(get_nmap_xml_script("host/", script))
+
+    return ip, host_data
+
+def iter_nmap_xml_hosts(xml_path):
+    """
+    Incrementally parses an nmap -oX file, yielding (ip, host entry) for each <host>
+    with open ports. Each <host> is thrown away once parsed so memory stays flat
+    """
+    root = None
+
+    with get_opener(xml_path)(xml_path, "rb") as f:
+        for event, element in ElementTree.iterparse(f, events=("start", "end")):
+            if root is None:
+                root = element
+                continue
+
+            if event != "end" or element.tag != "host":
+                continue
+
+            with stats_phase("parse"):
+                record = parse_nmap_xml_host(element)
+
+            # Hosts are direct children of <nmaprun>, so clearing the root drops everything parsed so far
+            element.clear()
+            root.clear()
+
+            if record is not None:
+                yield record
+
+def stream_nmap_xml_notes(folder_path, op_name, op_type, xml_path, correlator=None):
+    try:
+        stream_host_notes(folder_path, op_name, op_type, iter_nmap_xml_hosts(xml_path), correlator, "xml")
+    except Exception as e:
+        print("[!] Error parsing nmap xml file. Error: {0}".format(e))
+        return
+
+
+#                       #
+# Port record section #
+#                       #
+# masscan and other port scanners emit one record per open port, in no particular order. Records are
+# grouped by IP a batch at a time and fed into the same host entries the gnmap parser builds. An IP that
+# shows up again in a later batch, or that another input already wrote, is merged into its note (see PARSED_HOSTS)
+
+def iter_masscan_list(lines):
+    """
+    Yields (ip, port, service, version) from masscan -oL lines, e.g.
+    open tcp 80 1.2.3.4 1700000000
+    banner tcp 80 1.2.3.4 1700000000 http Server: nginx
+    """
+    for line in lines:
+        fields = line.split(" ", 6)
+        if len(fields) < 5:
+            continue
+
+        if fields[0] == "open":
+            yield fields[3], fields[2], "", ""
+        elif fields[0] == "banner" and len(fields) >= 6:
+            banner = fields[6] if len(fields) == 7 else ""
+            yield fields[3], fields[2], fields[5], banner
+
+def iter_json_port_records(lines):
+    """
+    Yields (ip, port, service, version) from JSON port records, one per line. Takes masscan -oJ
+    ({"ip":..., "ports":[{"port":80, "status":"open", "service":{"name":..., "banner":...}}]}) and
+    flat records like {"ip":..., "port":80, "service":"http", "version":"nginx"} (e.g. naabu -json)
+    """
+    for line in lines:
+        line = line.strip().rstrip(",")
+        if not line.startswith("{"):
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            stats_count("records_invalid")
+            continue
+
+        ip = record.get("ip") or record.get("address") or record.get("host") or ""
+        if not is_ip(ip):
+            continue
+
+        ports = record["ports"] if isinstance(record.get("ports"), list) else [record]
+        for port in ports:
+            state = port.get("status", port.get("state", "open"))
+            if state != "open" or port.get("port") is None:
+                continue
+
+            service = port.get("service", "")
+            version = port.get("version", "")
+            if isinstance(service, dict):
+                version = service.get("banner", "")
+                service = service.get("name", "")
+
+            yield ip, str(port["port"]), service or "", version or ""
+
+def iter_port_records(path, json_lines=False):
+    """
+    Yields (ip, port, service, version) from a masscan -oL/-oJ or JSON-lines file,
+    working out the format from the first record
+    """
+    lines = read_lines(path)
+
+    for line in lines:
+        if line.strip() == "" or line.startswith("#"):
+            continue
+
+        records = itertools.chain([line], lines)
+        if json_lines or line.lstrip()[0] in "[{":
+            yield from iter_json_port_records(records)
+        else:
+            yield from iter_masscan_list(records)
+        return
+
+def add_port_record(record, port, service, version):
+    """
+    Adds a port record to a HostRecord
+    """
+    record.add_port(port)
+    record.add_service(service)
+
+    if version != "":
+        version = " ".join(version.split())
+        if len(version) > SCRIPT_OUTPUT_LIMIT:
+            version = version[:SCRIPT_OUTPUT_LIMIT] + "..."
+        record.add_version(port + "/" + service + ": " + version)
+
+def iter_port_record_batches(records, batch_size=PORT_RECORD_BATCH_SIZE):
+    """
+    Groups port records by IP, batch_size records at a time
+    Yields a list of (ip, host entry) per batch
+    """
+    batch = HostStore()
+    count = 0
+
+    for ip, port, service, version in records:
+        add_port_record(batch.add(ip, "()"), port, service, version)
+
+        count += 1
+        if count >= batch_size:
+            yield list(batch.items())
+            batch = HostStore()
+            count = 0
+
+    if len(batch) != 0:
+        yield list(batch.items())
+
+def stream_port_record_notes(folder_path, op_name, op_type, path, json_lines=False, correlator=None,
+                             batch_size=PORT_RECORD_BATCH_SIZE):
+    content_folder = os.path.join(folder_path, "Content")
+    template = get_host_template(op_type)
+    new_hosts = [] if JOURNAL is not None else None
+
+    def on_skip(batch):
+        for ip, host_data in batch:
+            PARSED_HOSTS.setdefault(host_key(ip), host_data["rdns"])
+            if correlator is not None:
+                correlator.correlate(ip, host_data)
+
+    try:
+        records = iter_port_records(path, json_lines)
+        if SCOPE is not None:
+            # Records are dropped by IP before they're grouped, the names are checked once they're correlated
+            records = (record for record in records if not SCOPE.rejects_ip(record[0]))
+
+        batches = iter_port_record_batches(records, batch_size)
+        batches = iter_journaled("jsonl" if json_lines else "masscan", batches, on_skip=on_skip, size=len,
+                                 seen=new_hosts)
+
+        # Earlier inputs' notes have to be on disk before this one merges into them
+        WRITER.flush()
+        for batch in batches:
+            for ip, host_data in batch:
+                write_streamed_host(content_folder, template, op_name, ip, host_data, correlator, new_hosts)
+    except Exception as e:
+        print("[!] Error parsing port records from {0}. Error: {1}".format(path, e))
+        return
+
+
+#                     #
+# Correlation section #
+#                     #
+# Host lists and host maps are small next to scan output, so they are loaded into indexes keyed by IP and by
+# normalized host name. Each scanned host is then joined against them (by IP and by its reverse DNS name) as it
+# streams past, so every real host ends up in one record no matter how many inputs mention it
+
+def is_ip(value):
+    # inet_pton is several times faster than ipaddress, and this runs for every record
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            socket.inet_pton(family, value)
+            return True
+        except (OSError, ValueError):
+            continue
+
+    return False
+
+def get_subnet(ip):
+    """
+    Returns the /24 of an IPv4 address or the /64 of an IPv6 address, e.g. 10.0.0.0/24
+    """
+    if ":" not in ip:
+        return ip.rsplit(".", 1)[0] + ".0/24"
+
+    return str(ipaddress.ip_network(ip + "/64", strict=False))
+
+def get_subnet_sort_key(subnet):
+    network = ipaddress.ip_network(subnet)
+
+    return network.version, int(network.network_address)
+
+def normalize_host_name(name):
+    """
+    Lowercases and strips the scheme, path and trailing dot from a host name or URL.
+    Also takes gnmap style reverse DNS, e.g. (host.com)
+    """
+    name = name.strip()
+    if name.startswith("(") and name.endswith(")"):
+        name = name[1:-1]
+
+    return strip_domain(name).rstrip(".")
+
+def iter_host_list(host_list_path):
+    """
+    Yields the normalized host names from a host list file one line at a time
+    """
+    for host in read_lines(host_list_path):
+        host = normalize_host_name(host)
+        if host != "":
+            yield host
+
+def iter_host_map(host_map_path):
+    """
+    Yields (domain, ip) pairs from a host map file one line at a time.
+    ip is "" for hosts that didn't resolve
+    """
+    for host in read_lines(host_map_path):
+        if host.strip() == "":
+            continue
+
+        temp_arr = [field.strip() for field in host.split(",")]
+
+        if len(temp_arr) < 2:
+            print("[*] Missing full pair for {0} in host map. Skipping.".format(temp_arr[0]))
+            continue
+
+        # A little error handling for bad user input that flips host and IP, checked per line
+        domain, ip = temp_arr[0], temp_arr[1]
+        if is_ip(domain) and not is_ip(ip):
+            domain, ip = ip, domain
+
+        yield normalize_host_name(domain), ip
+
+class HostCorrelator:
+    """
+    Joins host list and host map entries onto scanned hosts
+
+    by_ip:   HostStore of the host map IPs, with their domains
+    by_name: {normalized name:ip} from the host map and host list ("" if the ip isn't known)
+    """
+    def __init__(self):
+        self.by_ip = HostStore()
+        self.by_name = {}
+        self.listed_names = {}
+        self.matched_ips = set()
+        self.matched_names = set()
+
+    def add_host_list(self, host_list_path):
+        for name in iter_host_list(host_list_path):
+            self.listed_names[name] = True
+            self.by_name.setdefault(name, "")
+
+    def add_host_map(self, host_map_path):
+        for name, ip in iter_host_map(host_map_path):
+            if self.by_name.get(name, "") == "":
+                self.by_name[name] = ip
+
+            if ip == "":
+                continue
+
+            self.by_ip.add(ip, domains=[name])
+
+    def correlate(self, ip, host_data):
+        """
+        Adds every known name for the host to its entry: the host map names for
+        its IP plus its reverse DNS name if that was listed in either input
+        """
+        record = self.by_ip.get(ip)
+        domains = []
+        # Only host map IPs are checked by iter_unmatched, so scanned IPs that aren't in it aren't kept
+        if record is not None:
+            domains = list(record.domains)
+            self.matched_ips.add(host_key(ip))
+
+        rdns = normalize_host_name(host_data["rdns"])
+        if rdns != "" and rdns in self.by_name and self.by_name[rdns] in ["", ip] and rdns not in domains:
+            domains.append(rdns)
+
+        for domain in host_data["domains"]:
+            if domain not in domains:
+                domains.append(domain)
+
+        self.matched_names.update(domains)
+        host_data["domains"] = domains
+
+        return host_data
+
+    def iter_unmatched(self, scan_present):
+        """
+        Yields (host, entry) for hosts that no scanned host was joined with. Host map IPs
+        are only included when there was no scan, to avoid notes for hosts without open ports
+        """
+        if not scan_present:
+            for ip, host_data in self.by_ip.items():
+                if host_key(ip) not in self.matched_ips:
+                    self.matched_names.update(host_data["domains"])
+                    yield ip, host_data
+
+        for name, ip in self.by_name.items():
+            if name in self.matched_names:
+                continue
+
+            # Listed names always get a note, unresolved host map names only if there was no scan
+            if name in self.listed_names or (ip == "" and not scan_present):
+                yield name, new_host(domains=[name])
+
+
+#               #
+# Scope section #
+#               #
+# parse --scope/--exclude files list one entry per line: CIDRs (10.0.0.0/16), single IPs, ranges (10.0.0.5-10.0.0.20
+# or 10.0.0.5-20), host names and wildcard domains (*.client.com, which also covers client.com). Blank lines and
+# anything after a # are skipped. Address entries are compiled into sorted, merged intervals so each lookup is a
+# binary search, and names into sets that are checked one parent domain at a time. A host is in scope if its IP or
+# one of its names is, and is dropped if its IP is excluded. Excluded names are only removed from the host
+
+class Scope:
+    """
+    Compiled --scope and --exclude files
+    """
+    def __init__(self, scope_path=None, exclude_path=None):
+        self.include = self._load(scope_path)
+        self.exclude = self._load(exclude_path)
+        self.has_scope = scope_path is not None
+        self.filtered = 0
+
+    def _load(self, path):
+        ranges = {4: [], 6: []}
+        names = set()
+        wildcards = set()
+
+        if path is not None:
+            for line in read_lines(path):
+                entry = line.split("#", 1)[0].strip()
+                if entry == "":
+                    continue
+
+                try:
+                    address_range = parse_scope_range(entry)
+                except ValueError:
+                    print("[!] Skipping invalid scope entry in {0}: {1}".format(path, entry))
+                    continue
+
+                if address_range is not None:
+                    version, start, end = address_range
+                    ranges[version].append((start, end))
+                    continue
+
+                name = normalize_host_name(entry[2:] if entry.startswith("*.") else entry)
+                if re.fullmatch(r"[a-z0-9_-]+(\.[a-z0-9_-]+)*", name) is None:
+                    print("[!] Skipping invalid scope entry in {0}: {1}".format(path, entry))
+                elif entry.startswith("*."):
+                    wildcards.add(name)
+                else:
+                    names.add(name)
+
+        return {"ranges": {version: merge_ranges(items) for version, items in ranges.items()}, "names": names,
+                "wildcards": wildcards}
+
+    def _contains_ip(self, index, ip):
+        key = host_key(ip)
+        if isinstance(key, int):
+            version = 4
+        else:
+            try:
+                version, key = 6, int(ipaddress.IPv6Address(ip))
+            except ValueError:
+                return False
+
+        starts, ends = index["ranges"][version]
+        position = bisect.bisect_right(starts, key) - 1
+
+        return position >= 0 and key <= ends[position]
+
+    def _contains_name(self, index, name):
+        name = normalize_host_name(name)
+        if name in index["names"]:
+            return True
+        if len(index["wildcards"]) == 0:
+            return False
+
+        labels = name.split(".")
+        return any(".".join(labels[i:]) in index["wildcards"] for i in range(len(labels) - 1))
+
+    def rejects_ip(self, ip):
+        """
+        Quick check for records that only have an IP so far. True if the IP is excluded, or
+        if the scope has no names that could still bring the host in and the IP isn't in scope
+        """
+        if self._contains_ip(self.exclude, ip):
+            self.filtered += 1
+            return True
+
+        names_in_scope = len(self.include["names"]) != 0 or len(self.include["wildcards"]) != 0
+        if self.has_scope and not names_in_scope and not self._contains_ip(self.include, ip):
+            self.filtered += 1
+            return True
+
+        return False
+
+    def check(self, ip, host_data):
+        """
+        Returns True if the host is in scope, after removing excluded names from host_data["domains"].
+        ip is None for host list names
+        """
+        if ip is not None and self._contains_ip(self.exclude, ip):
+            self.filtered += 1
+            return False
+
+        if len(self.exclude["names"]) != 0 or len(self.exclude["wildcards"]) != 0:
+            host_data["domains"] = [name for name in host_data["domains"] if not self._contains_name(self.exclude, name)]
+            if ip is None and len(host_data["domains"]) == 0:
+                self.filtered += 1
+                return False
+
+        if not self.has_scope:
+            return True
+        if ip is not None and self._contains_ip(self.include, ip):
+            return True
+        names = host_data["domains"] + [host_data.get("rdns", "")]
+        if any(self._contains_name(self.include, name) for name in names if name not in ["", "()"]):
+            return True
+
+        # Names can't be checked against address ranges, so they're kept if the scope has no names at all
+        if ip is None and len(self.include["names"]) == 0 and len(self.include["wildcards"]) == 0:
+            return True
+
+        self.filtered += 1
+        return False
+
+def parse_scope_range(entry):
+    """
+    Returns (IP version, first address, last address) as ints for a CIDR, IP or
+    range, None for anything else (names). Raises ValueError for bad addresses
+    """
+    if "-" in entry and entry.split("-", 1)[0].count(".") == 3 and not re.search(r"[a-zA-Z]", entry):
+        first, last = [part.strip() for part in entry.split("-", 1)]
+        if last.isdigit():
+            last = first.rsplit(".", 1)[0] + "." + last
+        first, last = ipaddress.IPv4Address(first), ipaddress.IPv4Address(last)
+        if last < first:
+            raise ValueError(entry)
+        return 4, int(first), int(last)
+
+    if re.fullmatch(r"[0-9.]+(/\d+)?", entry) or ":" in entry:
+        network = ipaddress.ip_network(entry, strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address)
+
+    return None
+
+def merge_ranges(ranges):
+    """
+    Sorts and merges overlapping/adjacent (start, end) ranges, returning ([starts], [ends])
+    """
+    starts = []
+    ends = []
+    for start, end in sorted(ranges):
+        if len(ends) != 0 and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    return starts, ends
+
+
+#               #
+# Watch section #
+#               #
+# watch follows scan output while the scan is still running. Each pass reads whatever complete gnmap
+# lines / xml <host> blocks were added since the stored offset, and the hosts they touch are written
+# (or merged into their existing notes) at most once per debounce interval
+
+class PollWaiter:
+    """
+    Waits for changes by sleeping, works everywhere
+    """
+    def add(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+class InotifyWaiter:
+    """
+    Waits for changes to the watched folders with inotify (Linux only), so new scan
+    output is picked up as soon as it's written instead of on the next poll
+    """
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENTS = 0x00000002 | 0x00000008 | 0x00000080 | 0x00000100
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def add(self, path):
+        folder = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+        if folder in self.watched:
+            return
+
+        if self.libc.inotify_add_watch(self.fd, folder.encode(), self.EVENTS) < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + folder)
+        self.watched.add(folder)
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return
+
+        # Only the wake up matters, every watched file gets checked afterwards
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+def get_waiter(use_polling):
+    if use_polling or not sys.platform.startswith("linux"):
+        return PollWaiter()
+
+    try:
+        return InotifyWaiter()
+    except Exception as e:
+        print("[*] inotify isn't available, falling back to polling. Error: {0}".format(e))
+        return PollWaiter()
+
+def get_watch_files(paths):
+    """
+    Expands the supplied files and folders into the scan files to follow
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in WATCH_EXTENSIONS:
+                    files.append(os.path.abspath(entry.path))
+        elif os.path.isfile(path):
+            files.append(os.path.abspath(path))
+
+    return files
+
+def load_watch_state(folder_path):
+    try:
+        with open(os.path.join(folder_path, WATCH_STATE_NAME), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print("[!] Error reading the watch state, starting from the beginning of each file. Error: {0}".format(e))
+        return {}
+
+def save_watch_state(folder_path, state):
+    try:
+        write_text_atomic(os.path.join(folder_path, WATCH_STATE_NAME), json.dumps(state, indent=2, sort_keys=True))
+    except Exception as e:
+        print("[!] Error writing the watch state. Error: {0}".format(e))
+
+def read_new_data(path, file_state, size=WATCH_READ_SIZE):
+    """
+    Returns up to size bytes added to a file since the stored offset. Starts over if
+    the file was replaced or truncated
+    """
+    stat = os.stat(path)
+    offset = file_state.get("offset", 0)
+
+    if file_state.get("inode") != stat.st_ino or stat.st_size < offset:
+        offset = 0
+    if stat.st_size == offset:
+        return offset, b""
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return offset, f.read(min(size, stat.st_size - offset))
+
+def parse_new_gnmap(data):
+    """
+    Parses the complete lines in newly added gnmap data
+    Returns the (ip, host entry) records and the number of bytes used
+    """
+    end = data.rfind(b"\n") + 1
+    lines = data[:end].decode(errors="replace").splitlines()
+    records = []
+
+    for line in filter_gnmap_lines(lines):
+        record = parse_gnmap_line(line)
+        if record is not None:
+            records.append(record)
+
+    return records, end
+
+def parse_new_nmap_xml(data):
+    """
+    Parses the complete <host> blocks in newly added nmap xml data
+    Returns the (ip, host entry) records and the number of bytes used
+    """
+    records = []
+    used = 0
+    incomplete_start = -1
+
+    while True:
+        start = data.find(b"<host", used)
+        # <hosthint> blocks aren't hosts
+        while start != -1 and data[start + 5:start + 6] not in [b" ", b">"]:
+            start = data.find(b"<host", start + 5)
+        if start == -1:
+            break
+
+        end = data.find(b"</host>", start)
+        if end == -1:
+            incomplete_start = start
+            break
+        end += len(b"</host>")
+
+        try:
+            record = parse_nmap_xml_host(ElementTree.fromstring(data[start:end]))
+            if record is not None:
+                records.append(record)
+        except ElementTree.ParseError as e:
+            print("[!] Skipping a malformed <host> block. Error: {0}".format(e))
+
+        used = end
+
+    # Nothing after the last complete host is needed until the next block starts
+    if used == 0:
+        used = incomplete_start if incomplete_start != -1 else max(len(data) - 6, 0)
+
+    return records, used
+
+def handle_watch(folder_path, op_name, op_type, paths, host_list_path=None, host_map_path=None, interval=2.0,
+                 debounce=5.0, use_polling=False, once=False, workers=DEFAULT_WORKERS):
+    global WRITER
+    global INDEX
+    content_folder = os.path.join(folder_path, "Content")
+    template = get_host_template(op_type)
+    state = load_watch_state(folder_path)
+    waiter = get_waiter(use_polling)
+
+    correlator = HostCorrelator()
+    if host_list_path is not None:
+        correlator.add_host_list(host_list_path)
+    if host_map_path is not None:
+        correlator.add_host_map(host_map_path)
+
+    load_layout(folder_path)
+    INDEX = open_index(folder_path)
+    load_manifest(INDEX, folder_path)
+    WRITER = NoteWriter(workers)
+
+    pending = HostStore()
+    pending_state = {}
+    first_pending_time = None
+
+    def flush():
+        nonlocal pending, pending_state, first_pending_time
+        for ip, host_data in pending.items():
+            host_data = correlator.correlate(ip, host_data)
+            write_host_note(content_folder, template, op_name, ip, host_data, merge=True)
+
+        WRITER.flush()
+        write_shard_indexes(content_folder)
+        save_manifest(INDEX)
+        flush_index(INDEX)
+        if len(pending) != 0:
+            write_rollups(INDEX, folder_path, op_name)
+        INDEX.commit()
+
+        # Offsets are only saved once the notes they cover are on disk, so a restart never skips hosts
+        state.update(pending_state)
+        save_watch_state(folder_path, state)
+
+        if len(pending) != 0:
+            print("[+] Updated {0} host(s)".format(len(pending)))
+
+        pending = HostStore()
+        pending_state = {}
+        first_pending_time = None
+
+    print("[*] Watching {0} for new scan output. Press Ctrl-C to stop.".format(", ".join(paths)))
+
+    try:
+        for path in paths:
+            waiter.add(path)
+
+        while True:
+            for file_path in get_watch_files(paths):
+                file_state = pending_state.get(file_path, state.get(file_path, {}))
+                read_size = WATCH_READ_SIZE
+
+                # The partial line/<host> block at the end of each read is read again with the next one
+                while True:
+                    try:
+                        offset, data = read_new_data(file_path, file_state, read_size)
+                    except OSError as e:
+                        print("[!] Error reading {0}. Error: {1}".format(file_path, e))
+                        break
+
+                    if len(data) == 0:
+                        break
+
+                    if file_path.lower().endswith(".xml"):
+                        records, used = parse_new_nmap_xml(data)
+                    else:
+                        records, used = parse_new_gnmap(data)
+
+                    file_state = {"offset": offset + used, "inode": os.stat(file_path).st_ino}
+                    pending_state[file_path] = file_state
+
+                    for ip, host_data in records:
+                        pending.merge(ip, host_data)
+
+                    if len(data) < read_size:
+                        break
+
+                    # Nothing used from a full read means a line or <host> block bigger than it
+                    read_size = WATCH_READ_SIZE if used > 0 else read_size * 2
+                    if len(pending) >= WATCH_FLUSH_HOSTS:
+                        flush()
+
+                if first_pending_time is None and len(pending_state) != 0:
+                    first_pending_time = time.monotonic()
+
+            if once:
+                break
+
+            if first_pending_time is not None and time.monotonic() - first_pending_time >= debounce:
+                flush()
+
+            waiter.wait(interval)
+    except KeyboardInterrupt:
+        print("\n[*] Stopping.")
+    finally:
+        flush()
+        waiter.close()
+        WRITER.close()
+        WRITER = None
+        INDEX.close()
+        INDEX = None
+
+
+#             #
+# Index section #
+#             #
+# Tables:
+#   notes(note, ip, rdns, examined, finding, followUp) - one row per note in Content
+#   ports(note, port) and services(note, service)       - the openPorts/services frontmatter
+#   rollups(name, hash)                                 - hash of each rollup note last written, see Rollup section
+#   manifest(note, hash)                                - hash of the scan data in each note, see Incremental section
+
+def get_index_path(folder_path):
+    return os.path.join(folder_path, INDEX_NAME)
+
+def open_index(folder_path):
+    """
+    Opens (and creates if needed) the SQLite index for an op folder. A new index is
+    filled from the notes already in Content so it never misses notes from earlier runs
+    """
+    index_path = get_index_path(folder_path)
+    is_new = not os.path.exists(index_path)
+
+    conn = sqlite3.connect(index_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS notes (note TEXT PRIMARY KEY, ip TEXT, rdns TEXT, examined INTEGER DEFAULT 0,
+                                          finding INTEGER DEFAULT 0, followUp INTEGER DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS ports (note TEXT, port TEXT, PRIMARY KEY (note, port));
+        CREATE TABLE IF NOT EXISTS services (note TEXT, service TEXT COLLATE NOCASE, PRIMARY KEY (note, service));
+        CREATE INDEX IF NOT EXISTS ports_by_port ON ports (port);
+        CREATE INDEX IF NOT EXISTS services_by_service ON services (service);
+        CREATE TABLE IF NOT EXISTS rollups (name TEXT PRIMARY KEY, hash TEXT);
+        CREATE TABLE IF NOT EXISTS manifest (note TEXT PRIMARY KEY, hash TEXT);
+    """)
+
+    if is_new:
+        refresh_index(conn, folder_path)
+
+    return conn
+
+def get_note_ip(file_name):
+    # Note names are "ip (rdns).md" or "domain - (ip) (rdns).md", possibly in a shard folder, see get_note_host
+    file_name = os.path.basename(file_name)
+    match = re.match(r"([\w.-]+) \(", file_name)
+    if match is None:
+        match = re.search(r" - \(([\w.-]+)\)", file_name)
+    if match is None:
+        return ""
+
+    ip = match.group(1).replace("-", ":")
+
+    return ip if is_ip(ip) else ""
+
+def index_host_note(conn, file_name, host_data, merged=False):
+    """
+    Queues the parsed data for a note to be added to the index by flush_index. Notes that were
+    merged keep the ports/services already indexed for them, fresh notes replace them
+    """
+    pending = INDEX_PENDING.get(file_name)
+    if pending is None or not merged:
+        pending = {"ip": get_note_ip(file_name), "replace": not merged, "ports": [], "services": []}
+        INDEX_PENDING[file_name] = pending
+
+    pending["rdns"] = host_data["rdns"]
+    pending["ports"] += host_data["ports"]
+    pending["services"] += host_data["services"]
+
+    if len(INDEX_PENDING) >= INDEX_BATCH_SIZE:
+        flush_index(conn)
+
+def flush_index(conn):
+    """
+    Adds the queued note rows to the index with one statement per table (and per
+    INDEX_DELETE_CHUNK replaced notes) instead of several per note
+    """
+    if len(INDEX_PENDING) == 0:
+        return
+
+    with stats_phase("index"):
+        conn.executemany("INSERT INTO notes (note, ip, rdns) VALUES (?, ?, ?) "
+                         + "ON CONFLICT(note) DO UPDATE SET ip = excluded.ip, rdns = excluded.rdns",
+                         [(note, pending["ip"], pending["rdns"]) for note, pending in INDEX_PENDING.items()])
+
+        replaced = [note for note, pending in INDEX_PENDING.items() if pending["replace"]]
+        for notes in iter_chunks(replaced, INDEX_DELETE_CHUNK):
+            placeholders = ", ".join("?" * len(notes))
+            conn.execute("DELETE FROM ports WHERE note IN ({0})".format(placeholders), notes)
+            conn.execute("DELETE FROM services WHERE note IN ({0})".format(placeholders), notes)
+            conn.execute("UPDATE notes SET examined = 0, finding = 0, followUp = 0 WHERE note IN ({0})".format(
+                placeholders), notes)
+
+        conn.executemany("INSERT OR IGNORE INTO ports VALUES (?, ?)",
+                         [(note, port) for note, pending in INDEX_PENDING.items() for port in pending["ports"]])
+        conn.executemany("INSERT OR IGNORE INTO services VALUES (?, ?)",
+                         [(note, service) for note, pending in INDEX_PENDING.items()
+                          for service in pending["services"]])
+
+    INDEX_PENDING.clear()
+
+def read_frontmatter(file_path):
+    """
+    Reads only the frontmatter block at the top of a note and returns it as a dict.
+    Fields with list items are returned as lists, everything else as a string
+    """
+    frontmatter = {}
+    field_name = None
+
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        if f.readline().strip() != "---":
+            return frontmatter
+
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.strip() == "---":
+                break
+
+            if line.startswith("  - ") or line.startswith("- "):
+                if field_name is not None:
+                    if not isinstance(frontmatter[field_name], list):
+                        frontmatter[field_name] = []
+                    item = line.strip()[2:].strip()
+                    if len(item) >= 2 and item[0] == item[-1] and item[0] in "\"'":
+                        item = item[1:-1].replace("\\\"", "\"").replace("\\\\", "\\")
+                    frontmatter[field_name].append(item)
+                continue
+
+            name, sep, value = line.partition(":")
+            if sep == "":
+                continue
+            field_name = name.strip()
+            frontmatter[field_name] = value.strip()
+
+    return frontmatter
+
+def is_true(value):
+    return isinstance(value, str) and value.lower() == "true"
+
+def as_list(value):
+    if isinstance(value, list):
+        return value
+    if value is None or value == "":
+        return []
+
+    return [value]
+
+def refresh_index(conn, folder_path):
+    """
+    Rebuilds the index from the frontmatter of the notes in Content
+    """
+    content_folder = os.path.join(folder_path, "Content")
+    conn.execute("DELETE FROM notes")
+    conn.execute("DELETE FROM ports")
+    conn.execute("DELETE FROM services")
+
+    if not os.path.isdir(content_folder):
+        conn.commit()
+        return 0
+
+    count = 0
+    for note, note_path in iter_note_files(content_folder):
+        try:
+            frontmatter = read_frontmatter(note_path)
+        except Exception as e:
+            print("[!] Error reading note {0}. Error: {1}".format(note, e))
+            continue
+
+        rdns = re.search(r"(\([^()]*\))\.md$", note)
+        conn.execute("INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?)",
+                     (note, get_note_ip(note), rdns.group(1) if rdns else "",
+                      is_true(frontmatter.get("examined")), is_true(frontmatter.get("finding")),
+                      is_true(frontmatter.get("followUp"))))
+        conn.executemany("INSERT OR IGNORE INTO ports VALUES (?, ?)",
+                         [(note, p) for p in as_list(frontmatter.get("openPorts"))])
+        conn.executemany("INSERT OR IGNORE INTO services VALUES (?, ?)",
+                         [(note, s) for s in as_list(frontmatter.get("services"))])
+        count += 1
+
+    conn.commit()
+
+    return count
+
+def query_index(conn, port=None, service=None, finding=False, follow_up=False):
+    """
+    Returns (note, ip) rows for notes matching every supplied filter
+    """
+    sql = "SELECT note, ip FROM notes WHERE 1 = 1"
+    params = []
+
+    if port is not None:
+        sql += " AND note IN (SELECT note FROM ports WHERE port = ?)"
+        params.append(str(port))
+    if service is not None:
+        sql += " AND note IN (SELECT note FROM services WHERE service LIKE ?)"
+        params.append("%" + service + "%")
+    if finding:
+        sql += " AND finding = 1"
+    if follow_up:
+        sql += " AND followUp = 1"
+
+    return conn.execute(sql + " ORDER BY note", params).fetchall()
+
+def handle_index(folder_path):
+    start_time = time.perf_counter()
+    conn = open_index(folder_path)
+    count = refresh_index(conn, folder_path)
+
+    op_name = get_op_name(folder_path)
+    if op_name is not None:
+        write_rollups(conn, folder_path, op_name)
+        conn.commit()
+    conn.close()
+
+    print("[+] Indexed {0} notes in {1:.2f}s".format(count, time.perf_counter() - start_time))
+
+def handle_query(folder_path, port, service, finding, follow_up):
+    start_time = time.perf_counter()
+    conn = open_index(folder_path)
+    rows = query_index(conn, port, service, finding, follow_up)
+    conn.close()
+
+    for note, ip in rows:
+        print(note[:-3])
+
+    print("\n[+] {0} notes matched in {1:.1f} ms".format(len(rows), (time.perf_counter() - start_time) * 1000))
+
+
+#                #
+# Rollup section #
+#                #
+# The Tracker's DataView port/service queries read every host note each time the tracker opens. Instead, parse
+# groups the index into port -> hosts, service -> hosts and /24 -> hosts and writes one static note per group,
+# plus a summary note per kind that the tracker links to. Only rollups whose text changed are rewritten
+
+def get_op_name(folder_path):
+    """
+    Returns the op name from the OpName-Tracker.md file in an op folder, or None if there isn't one
+    """
+    for entry in os.scandir(folder_path):
+        if entry.is_file() and entry.name.endswith("-Tracker.md"):
+            return entry.name[:-len("-Tracker.md")]
+
+    return None
+
+def get_rollup_name(op_name, kind, key):
+    # Names are prefixed with the op so they stay unique in vaults shared by several ops
+    return "{0}-{1}-{2}".format(op_name, kind, re.sub(r"[\\/:*?\"<>|#^\[\]]", "_", key))
+
+def get_note_link(note):
+    return "[[" + os.path.basename(note)[:-3] + "]]"
+
+def get_subnet_order(ip):
+    # A string that sorts subnets numerically in SQL, IPv4 before IPv6
+    version, start = get_subnet_sort_key(get_subnet(ip))
+
+    return "{0}-{1:032x}".format(version, start)
+
+def iter_rollup_groups(conn, kind):
+    """
+    Yields (key, [notes]) for one kind of rollup, in display order. The index does the sorting,
+    so only one group's notes are in memory at a time
+    """
+    if kind == "Port":
+        rows = conn.execute("SELECT port, note FROM ports ORDER BY CAST(port AS INTEGER), port, note")
+    elif kind == "Service":
+        rows = conn.execute("SELECT lower(service), note FROM services ORDER BY lower(service), note")
+    else:
+        conn.create_function("subnet", 1, get_subnet, deterministic=True)
+        conn.create_function("subnet_order", 1, get_subnet_order, deterministic=True)
+        rows = conn.execute("SELECT subnet(ip), note FROM notes WHERE ip != '' ORDER BY subnet_order(ip), note")
+
+    for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield key, [note for _, note in group]
+
+def iter_rollup_notes(conn, op_name):
+    """
+    Yields (name, text) for every rollup note and the summary notes that link them
+    """
+    header = "*Generated by vault-generator.py from the op's index. Rewritten by parse, don't edit.*"
+
+    for kind, summary in ROLLUP_KINDS.items():
+        rows = []
+        for key, notes in iter_rollup_groups(conn, kind):
+            name = get_rollup_name(op_name, kind, key)
+            lines = ["# {0} {1}".format(kind, key), header, "", "Hosts ({0}):".format(len(notes))]
+            lines += ["- " + get_note_link(note) for note in notes]
+            rows.append("| [[{0}\\|{1}]] | {2} |".format(name, key, len(notes)))
+
+            yield name, "\n".join(lines) + "\n"
+
+        lines = ["# " + summary, header, "", "| {0} | Hosts |".format(kind), "| --- | --- |"] + rows
+        yield op_name + "-" + summary, "\n".join(lines) + "\n"
+
+def write_rollups(conn, folder_path, op_name):
+    """
+    Writes the rollup notes that changed since the last run and removes ones with no hosts left
+    """
+    rollup_folder = os.path.join(folder_path, ROLLUP_FOLDER)
+    try:
+        create_directory(rollup_folder)
+    except Exception as e:
+        print(e)
+        return
+
+    previous = dict(conn.execute("SELECT name, hash FROM rollups"))
+    current = set()
+    written = 0
+
+    for name, text in iter_rollup_notes(conn, op_name):
+        current.add(name)
+        text_hash = hashlib.sha1(text.encode()).hexdigest()
+        file_path = os.path.join(rollup_folder, name + ".md")
+        if previous.get(name) == text_hash and os.path.exists(file_path):
+            continue
+
+        try:
+            write_text_atomic(file_path, text)
+        except Exception as e:
+            print("Error writing to file: {0}.\n\nError: {1}".format(file_path, e))
+            continue
+
+        conn.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?)", (name, text_hash))
+        written += 1
+
+    for name in previous.keys() - current:
+        try:
+            os.remove(os.path.join(rollup_folder, name + ".md"))
+        except FileNotFoundError:
+            pass
+        conn.execute("DELETE FROM rollups WHERE name = ?", (name,))
+
+    stats_count("rollups_written", written)
+
+
+#                #
+# Canvas section #
+#                #
+# canvas lays out every host note as a file node, grouped by /24 or registered domain. Related Host(s) links become
+# edges between hosts and findings embedded from OpName-Findings become nodes linked to the hosts they were found on.
+# Groups are sorted and packed in rows, each one a square-ish grid, so the layout is O(n log n) and stable between runs
+
+def get_vault_root(folder_path):
+    """
+    Returns the vault folder an op folder lives in (the nearest parent with .obsidian)
+    Canvas file paths are relative to it
+    """
+    path = os.path.abspath(folder_path)
+    while True:
+        if os.path.isdir(os.path.join(path, ".obsidian")):
+            return path
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return os.path.dirname(os.path.abspath(folder_path))
+        path = parent
+
+def get_note_links(text):
+    """
+    Returns the Related Host(s) link targets and the Findings headings linked from a note
+    """
+    related = []
+    findings = []
+
+    for line in text.splitlines():
+        for target, heading in re.findall(r"\[\[([^\]|#]*)(#[^\]|]*)?(?:\|[^\]]*)?\]\]", line):
+            target = target.strip()
+            if target == "":
+                continue
+
+            if target.endswith("-Findings") and heading != "":
+                findings.append((target, heading[1:].strip()))
+            elif line.startswith("Related Host(s):"):
+                related.append(os.path.basename(target))
+
+    return related, findings
+
+def get_canvas_cluster(note, group_by):
+    """
+    Returns the group a host note goes in on the canvas
+    """
+    name = os.path.basename(note)[:-3]
+    ip = get_note_ip(note)
+
+    if group_by == "subnet":
+        return get_subnet(ip) if ip != "" else "Unresolved"
+
+    if " - (" in name:
+        domain = name.split(" - (")[0]
+    elif ip != "":
+        rdns = re.search(r"\(([^()]*)\)$", name)
+        domain = rdns.group(1) if rdns is not None else ""
+    else:
+        domain = name
+    registered_domain = get_registered_domain(domain)
+
+    return registered_domain if registered_domain != "" else "No Domain"
+
+def get_cluster_sort_key(cluster):
+    # Subnets sort numerically, Unresolved/No Domain go last
+    if "/" in cluster:
+        return (0, get_subnet_sort_key(cluster), "")
+    if cluster in ["Unresolved", "No Domain"]:
+        return (2, [], cluster)
+
+    return (1, [], cluster)
+
+def get_canvas_id(*parts):
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()[:16]
+
+def split_canvas_clusters(clusters, max_nodes):
+    """
+    Splits the sorted (cluster, notes) list into chunks of at most max_nodes notes.
+    Clusters are kept whole unless a single cluster is bigger than max_nodes
+    """
+    chunks = []
+    current = []
+    count = 0
+
+    for cluster, notes in clusters:
+        parts = [notes[i:i + max_nodes] for i in range(0, len(notes), max_nodes)]
+        for part_index, part in enumerate(parts):
+            label = cluster if len(parts) == 1 else "{0} ({1}/{2})".format(cluster, part_index + 1, len(parts))
+            if count + len(part) > max_nodes and len(current) != 0:
+                chunks.append(current)
+                current = []
+                count = 0
+            current.append((label, part))
+            count += len(part)
+
+    if len(current) != 0:
+        chunks.append(current)
+
+    return chunks
+
+def build_canvas(clusters, vault_content_path, links, findings_path):
+    """
+    Returns the canvas JSON data for a list of (label, notes) groups
+    links is {note: (related note names, findings headings)}
+    """
+    nodes = []
+    edges = []
+    node_ids = {}
+    x = 0
+    y = 0
+    row_height = 0
+
+    for label, notes in clusters:
+        columns = math.ceil(math.sqrt(len(notes)))
+        rows = math.ceil(len(notes) / columns)
+        width = columns * (CANVAS_NODE_WIDTH + CANVAS_GAP) + CANVAS_GAP
+        height = rows * (CANVAS_NODE_HEIGHT + CANVAS_GAP) + CANVAS_GAP
+
+        if x > 0 and x + width > CANVAS_ROW_WIDTH:
+            x = 0
+            y += row_height + CANVAS_GAP * 3
+            row_height = 0
+
+        nodes.append({"id": get_canvas_id("group", label), "type": "group", "x": x, "y": y, "width": width,
+                      "height": height, "label": label})
+
+        for index, note in enumerate(notes):
+            node_id = get_canvas_id("note", note)
+            node_ids[os.path.basename(note)[:-3]] = node_id
+            nodes.append({"id": node_id, "type": "file",
+                          "file": os.path.join(vault_content_path, note).replace(os.sep, "/"),
+                          "x": x + CANVAS_GAP + (index % columns) * (CANVAS_NODE_WIDTH + CANVAS_GAP),
+                          "y": y + CANVAS_GAP + (index // columns) * (CANVAS_NODE_HEIGHT + CANVAS_GAP),
+                          "width": CANVAS_NODE_WIDTH, "height": CANVAS_NODE_HEIGHT})
+
+        x += width + CANVAS_GAP * 3
+        row_height = max(row_height, height)
+
+    # Findings go in a column to the left of the hosts
+    finding_ids = {}
+    seen_edges = set()
+    for _, notes in clusters:
+        for note in notes:
+            related, findings = links.get(note, ([], []))
+            from_id = node_ids[os.path.basename(note)[:-3]]
+
+            for heading in findings:
+                if heading not in finding_ids:
+                    finding_ids[heading] = get_canvas_id("finding", heading)
+                    nodes.append({"id": finding_ids[heading], "type": "file", "file": findings_path,
+                                  "subpath": "#" + heading, "x": -(CANVAS_NODE_WIDTH + CANVAS_GAP * 4),
+                                  "y": (len(finding_ids) - 1) * (CANVAS_NODE_HEIGHT + CANVAS_GAP),
+                                  "width": CANVAS_NODE_WIDTH, "height": CANVAS_NODE_HEIGHT, "color": "1"})
+                edges.append({"id": get_canvas_id("edge", from_id, finding_ids[heading]), "fromNode": from_id,
+                              "toNode": finding_ids[heading], "label": "finding"})
+
+            # Links can go both ways, only draw each pair once. Hosts on other canvases are left out
+            for name in related:
+                to_id = node_ids.get(name)
+                pair = tuple(sorted([from_id, to_id or ""]))
+                if to_id is None or to_id == from_id or pair in seen_edges:
+                    continue
+                seen_edges.add(pair)
+                edges.append({"id": get_canvas_id("edge", *pair), "fromNode": from_id, "toNode": to_id})
+
+    return {"nodes": nodes, "edges": edges}
+
+def handle_canvas(folder_path, group_by="subnet", max_nodes=CANVAS_MAX_NODES):
+    start_time = time.perf_counter()
+    content_folder = os.path.join(folder_path, "Content")
+    op_name = get_op_name(folder_path)
+    if op_name is None:
+        print("Error: Could not find the op's Tracker note in {0}.".format(folder_path))
+        sys.exit(1)
+
+    vault_root = get_vault_root(folder_path)
+    vault_op_path = os.path.relpath(os.path.abspath(folder_path), vault_root)
+    vault_op_path = "" if vault_op_path == "." else vault_op_path
+    findings_path = os.path.join(vault_op_path, op_name + "-Findings.md").replace(os.sep, "/")
+
+    clusters = {}
+    links = {}
+    link_count = 0
+    for note, note_path in iter_note_files(content_folder):
+        try:
+            with open(note_path, "r", encoding="utf-8", errors="replace") as f:
+                related, findings = get_note_links(f.read())
+        except Exception as e:
+            print("[!] Error reading note {0}. Error: {1}".format(note, e))
+            continue
+
+        clusters.setdefault(get_canvas_cluster(note, group_by), []).append(note)
+        links[note] = (related, [heading for _, heading in findings])
+        link_count += len(related) + len(findings)
+
+    sorted_clusters = [(cluster, sorted(clusters[cluster])) for cluster in sorted(clusters, key=get_cluster_sort_key)]
+    chunks = split_canvas_clusters(sorted_clusters, max(max_nodes, 1))
+
+    canvas_names = []
+    for index, chunk in enumerate(chunks):
+        name = op_name + "-Hosts.canvas" if len(chunks) == 1 else "{0}-Hosts-{1}.canvas".format(op_name, index + 1)
+        canvas = build_canvas(chunk, os.path.join(vault_op_path, "Content"), links, findings_path)
+        write_file(folder_path, name, json.dumps(canvas, indent="\t"))
+        canvas_names.append(name)
+
+    # Remove canvases left over from an earlier run that needed more of them
+    for entry in os.scandir(folder_path):
+        if re.fullmatch(re.escape(op_name) + r"-Hosts(-\d+)?\.canvas", entry.name) and entry.name not in canvas_names:
+            os.remove(entry.path)
+
+    print("[+] Wrote {0} canvas(es) with {1} hosts in {2} groups ({3} links) in {4:.2f}s".format(
+        len(canvas_names), len(links), len(clusters), link_count, time.perf_counter() - start_time))
+    for name in canvas_names:
+        print("    " + name)
+
+
+#                #
+# Export section #
+#                #
+# export streams one row per host note and one per finding heading out as CSV or JSON lines. Notes are listed
+# with os.scandir and handed to a process pool a chunk at a time, with only a few chunks in flight, so memory
+# stays bounded however many notes the op has and the rows come out in the order the notes were listed
+
+def get_export_row(note, note_path):
+    frontmatter = read_frontmatter(note_path)
+    row = {"type": "host", "note": os.path.basename(note)[:-3], "ip": get_note_ip(note)}
+
+    for field_name in EXPORT_FIELDS:
+        value = frontmatter.get(field_name, "")
+        if field_name in EXPORT_FLAGS:
+            row[field_name] = is_true(value)
+        elif field_name == "privilegeLevel":
+            row[field_name] = value if isinstance(value, str) else ", ".join(value)
+        else:
+            row[field_name] = as_list(value)
+
+    return row
+
+def get_export_rows(notes):
+    """
+    Reads the frontmatter of a chunk of (note, full path) and returns their export rows. Runs in the process pool
+    """
+    rows = []
+    for note, note_path in notes:
+        try:
+            rows.append(get_export_row(note, note_path))
+        except Exception as e:
+            print("[!] Error reading note {0}. Error: {1}".format(note, e), file=sys.stderr)
+
+    return rows
+
+def iter_export_host_rows(content_folder, processes=None):
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    chunks = iter_chunks(iter_note_files(content_folder), EXPORT_CHUNK_SIZE)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = [executor.submit(get_export_rows, chunk) for chunk in itertools.islice(chunks, processes * 2)]
+        while len(pending) != 0:
+            rows = pending.pop(0).result()
+
+            # Keep the pool busy while this chunk is written, without queueing up the whole op
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(executor.submit(get_export_rows, chunk))
+
+            yield from rows
+
+def iter_finding_headings(findings_path):
+    """
+    Yields the headings of an OpName-Findings note, skipping the title, the template's
+    placeholder findings and anything in code blocks
+    """
+    fence = None
+    for line_number, line in enumerate(read_lines(findings_path)):
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            # A block opened with ```` is only closed by ````, so it can hold ``` examples
+            marker = stripped[:len(stripped) - len(stripped.lstrip("`"))]
+            if fence is None:
+                fence = marker
+            elif marker == fence:
+                fence = None
+            continue
+
+        match = re.match(r"(#{1,6}) +(.+?) *#*$", line)
+        if fence is not None or match is None or (line_number == 0 and len(match.group(1)) == 1):
+            continue
+        if match.group(2) == "Finding Title":
+            continue
+
+        yield match.group(2)
+
+def iter_export_finding_rows(folder_path, op_name):
+    findings_path = os.path.join(folder_path, op_name + "-Findings.md")
+    if not os.path.isfile(findings_path):
+        return
+
+    for heading in iter_finding_headings(findings_path):
+        row = {column: None for column in EXPORT_COLUMNS}
+        row.update({"type": "finding", "note": op_name + "-Findings#" + heading})
+        yield row
+
+def format_csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, list):
+        return ";".join(value)
+
+    return value
+
+def handle_export(folder_path, output_path=None, output_format="csv", processes=None):
+    start_time = time.perf_counter()
+    op_name = get_op_name(folder_path)
+    if op_name is None:
+        print("Error: Could not find the op's Tracker note in {0}.".format(folder_path))
+        sys.exit(1)
+
+    rows = itertools.chain(iter_export_host_rows(os.path.join(folder_path, "Content"), processes),
+                           iter_export_finding_rows(folder_path, op_name))
+
+    # Without -o the rows go to stdout, so progress messages go to stderr instead
+    if output_path is None:
+        output = sys.stdout
+    else:
+        output = open(output_path, "w", newline="", encoding="utf-8")
+
+    counts = {"host": 0, "finding": 0}
+    try:
+        if output_format == "csv":
+            writer = csv.writer(output)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in rows:
+                writer.writerow([format_csv_value(row[column]) for column in EXPORT_COLUMNS])
+                counts[row["type"]] += 1
+        else:
+            for row in rows:
+                output.write(json.dumps(row) + "\n")
+                counts[row["type"]] += 1
+    except BrokenPipeError:
+        # Piped into something like head that stopped reading, so stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print("[+] Exported {0} hosts and {1} findings in {2:.2f}s".format(counts["host"], counts["finding"],
+          time.perf_counter() - start_time), file=sys.stderr if output_path is None else sys.stdout)
+
+
+#                #
+# Images section #
+#                #
+# Screenshot tools name their files after the URL, e.g. https-10.0.0.5-443.png (gowitness) or
+# https__www_client_com__443.png (aquatone). File names and host names are both reduced to lowercase words
+# separated by _, and the longest run of words in a file name that matches a note's IP, domain, reverse DNS name
+# or alias decides which notes the screenshot is embedded in. Hashing, copying and thumbnailing run in a process pool
+
+def get_screenshot_key(text):
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_")
+
+def get_screenshot_files(screenshots_path):
+    files = []
+    for root, dirs, file_names in os.walk(screenshots_path):
+        for file_name in file_names:
+            if os.path.splitext(file_name)[1].lower() in SCREENSHOT_EXTENSIONS:
+                files.append(os.path.join(root, file_name))
+
+    return sorted(files)
+
+def get_screenshot_name(file_hash, path):
+    return file_hash[:16] + os.path.splitext(path)[1].lower()
+
+def get_thumbnail_name(file_hash):
+    return file_hash[:16] + "-thumb.jpg"
+
+def store_screenshot(path, file_hash, screenshot_folder, thumbnail_size=THUMBNAIL_SIZE):
+    """
+    Copies a screenshot into the op under its hash and makes its thumbnail if Pillow is installed.
+    Runs in the process pool. Returns the name to embed in notes
+    """
+    dest_path = os.path.join(screenshot_folder, get_screenshot_name(file_hash, path))
+    if not os.path.exists(dest_path):
+        fd, temp_path = tempfile.mkstemp(dir=screenshot_folder, suffix=".tmp")
+        os.close(fd)
+        try:
+            if not reflink_file(path, temp_path):
+                shutil.copyfile(path, temp_path)
+            set_file_mode(temp_path, dest_path)
+            os.replace(temp_path, dest_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    if Image is None:
+        return os.path.basename(dest_path)
+
+    thumbnail_path = os.path.join(screenshot_folder, THUMBNAIL_FOLDER, get_thumbnail_name(file_hash))
+    if not os.path.exists(thumbnail_path):
+        with Image.open(dest_path) as image:
+            image.thumbnail((thumbnail_size, thumbnail_size))
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(thumbnail_path), suffix=".tmp")
+            os.close(fd)
+            try:
+                image.convert("RGB").save(temp_path, "JPEG", quality=80)
+                set_file_mode(temp_path, thumbnail_path)
+                os.replace(temp_path, thumbnail_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+
+    return os.path.basename(thumbnail_path)
+
+def get_screenshot_hosts(content_folder):
+    """
+    Returns {screenshot key:[notes]} for the IP, domain, reverse DNS name and aliases of every host note
+    """
+    hosts = {}
+    for note, note_path in iter_note_files(content_folder):
+        ip = get_note_ip(note)
+        names = [ip] if ip != "" else [os.path.basename(note)[:-3]]
+        names += [get_note_domain(note), get_note_rdns(note)[1:-1]]
+        if ALIAS_NOTES:
+            names += as_list(read_frontmatter(note_path).get("aliases"))
+
+        for key in set(get_screenshot_key(name) for name in names):
+            if key != "":
+                hosts.setdefault(key, []).append(note)
+
+    return hosts
+
+def match_screenshot(path, hosts):
+    """
+    Returns the notes a screenshot belongs to, from the longest run of words in its file
+    name that is a known host
+    """
+    words = get_screenshot_key(os.path.splitext(os.path.basename(path))[0]).split("_")
+    for length in range(len(words), 0, -1):
+        for start in range(len(words) - length + 1):
+            key = "_".join(words[start:start + length])
+            if key in hosts:
+                return hosts[key]
+
+    return []
+
+def embed_screenshots(note_path, names):
+    """
+    Adds embeds for the screenshots to the note under the Screenshots heading, skipping ones it already has.
+    Returns True if the note was changed
+    """
+    contents = get_file_contents(note_path)
+    text = "\n".join(contents)
+    embeds = []
+    for name in names:
+        # Thumbnails and full size copies share the hash, so either one counts as embedded already
+        if name[:16] in text:
+            continue
+        if Image is None:
+            embeds.append("![[{0}|{1}]]".format(name, THUMBNAIL_SIZE))
+        else:
+            embeds.append("![[{0}]]".format(name))
+
+    if len(embeds) == 0:
+        return False
+
+    if SCREENSHOT_HEADING in contents:
+        index = contents.index(SCREENSHOT_HEADING) + 1
+        contents[index:index] = embeds
+    else:
+        contents += ["", SCREENSHOT_HEADING] + embeds
+
+    write_text_atomic(note_path, "\n".join(contents) + "\n")
+
+    return True
+
+def handle_images(folder_path, screenshots_path, thumbnail_size=THUMBNAIL_SIZE, processes=None):
+    start_time = time.perf_counter()
+    content_folder = os.path.join(folder_path, "Content")
+    screenshot_folder = os.path.join(folder_path, "Images", SCREENSHOT_FOLDER)
+    create_directory(screenshot_folder, True)
+    load_layout(folder_path)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if Image is not None:
+        create_directory(os.path.join(screenshot_folder, THUMBNAIL_FOLDER))
+    else:
+        print("[*] Pillow isn't installed (pip install Pillow), so full size screenshots are embedded instead of "
+              "thumbnails.")
+
+    files = get_screenshot_files(screenshots_path)
+    if len(files) == 0:
+        print("[!] No screenshots ({0}) found in {1}".format(", ".join(SCREENSHOT_EXTENSIONS), screenshots_path))
+        return
+
+    # Identical screenshots (e.g. the same login page on hundreds of hosts) are only stored once
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(processes, 1)) as executor:
+        hashes = list(executor.map(hash_file, files, chunksize=16))
+        unique = {}
+        for path, file_hash in zip(files, hashes):
+            unique.setdefault(file_hash, path)
+
+        futures = {file_hash: executor.submit(store_screenshot, path, file_hash, screenshot_folder, thumbnail_size)
+                   for file_hash, path in unique.items()}
+        names = {}
+        for file_hash, future in futures.items():
+            try:
+                names[file_hash] = future.result()
+            except Exception as e:
+                print("[!] Error adding screenshot {0}. Error: {1}".format(unique[file_hash], e))
+
+    hosts = get_screenshot_hosts(content_folder)
+    embeds = {}
+    unmatched = 0
+    for path, file_hash in zip(files, hashes):
+        notes = match_screenshot(path, hosts)
+        if len(notes) == 0 or file_hash not in names:
+            unmatched += 1
+            continue
+
+        for note in notes:
+            note_embeds = embeds.setdefault(note, [])
+            if names[file_hash] not in note_embeds:
+                note_embeds.append(names[file_hash])
+
+    updated = 0
+    for note, names_to_embed in embeds.items():
+        try:
+            if embed_screenshots(os.path.join(content_folder, note), names_to_embed):
+                updated += 1
+        except Exception as e:
+            print("[!] Error adding screenshots to {0}. Error: {1}".format(note, e))
+
+    print("[+] Added {0} screenshots ({1} unique) to {2} notes in {3:.2f}s".format(len(files), len(names), updated,
+          time.perf_counter() - start_time))
+    if unmatched != 0:
+        print("[*] {0} screenshots didn't match a host note. They're still in {1}".format(unmatched, screenshot_folder))
+
+
+def set_asset_options(link, asset_store):
+    global ASSET_LINK
+    global ASSET_STORE_PATH
+
+    ASSET_LINK = link
+    ASSET_STORE_PATH = asset_store
+
+def set_template_values(var_args):
+    global TEMPLATE_VALUES
+
+    for var in var_args:
+        name, sep, value = var.partition("=")
+        if sep == "" or name not in TEMPLATE_VARIABLES:
+            print("Error: --var {0} must be of format NAME=VALUE with NAME listed in TEMPLATE_VARIABLES".format(var))
+            sys.exit(1)
+        TEMPLATE_VALUES[name] = value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A program to quickly set up notes for an operation.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    # Assessment init
+    parser_init = subparsers.add_parser( "init", help="Initialize an assessment folder or vault at the target location")
+    parser_init.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the folder where you "
+                    + "want the folder or vault created. "
+                    + "NOTE 1: If you already have a vault, give the vault folder path to put this in the root of the vault, "
+                    + "or designate one of the subfolders you have (e.g. vault/assessments). "
+                    + "NOTE 2: This will NOT create a templates folder, presuming you already have one. Add "
+                    + "--template if you'd like a template folder placed in the operation folder to copy out.")
+    parser_init.add_argument("-n", "--name", help="REQUIRED (unless using --batch) - The operation codename.")
+    parser_init.add_argument("-t", "--type", help="REQUIRED (unless using --batch) - The operation type: internal or "
+                             + "external", choices=["internal", "external"], type=str.lower)
+    parser_init.add_argument("--vault", help="Creates an entire vault rather than a simple folder, using the op name for the "
+                    + "vault folder name. Will create the op folder and 01-Templates. Set your Obsidian settings to use "
+                    + "01-Templates as the template folder. Optional: replace the provided templates/obsidian folder in "
+                    + "this project with your with your own Obsidian settings. You will need at least the DataView "
+                    + "plugin installed and add the contents of types.json.",
+                    action="store_true")
+    parser_init.add_argument("--reusable", help="Use with --vault to create a vault structure to support multiple ops. Will "
+                    + "instead name the vault AssessmentNotes and create a sub-folder for the designated op. Other ops can "
+                    + "then be added by not supplying --vault in the future.", action="store_true")
+    parser_init.add_argument("--template", help="Creates a template folder in the operation folder without creating the "
+                    + "whole vault.", action="store_true")
+    parser_init.add_argument("--var", action="append", default=[], metavar="NAME=VALUE", help="Value for text listed "
+                    + "in TEMPLATE_VARIABLES to replace in the stock files. Can be supplied multiple times.")
+    parser_init.add_argument("--stats", action="store_true", help="Print per-phase timings and counters as JSON "
+                    + "when finished.")
+    parser_init.add_argument("--profile", metavar="PATH", help="Write a cProfile/pstats profile of the run to PATH.")
+    parser_init.add_argument("--batch", metavar="FILE", help="Create every op listed in FILE, one OpName,internal or "
+                    + "OpName,external per line, instead of -n/-t. Existing ops are skipped. With --vault --reusable, "
+                    + "all of the ops go in the one vault.")
+    parser_init.add_argument("--link", choices=ASSET_LINK_MODES, default=ASSET_LINK, help="How plugin/settings/template "
+                    + "files are put in new vaults: auto (default) reflinks where the filesystem supports it, otherwise "
+                    + "hardlinks plugin files and copies the rest. copy always makes full copies.")
+    parser_init.add_argument("--asset-store", metavar="PATH", help="Folder for the shared copy of vault files that is "
+                    + "linked from (default: templates/.assets). Hardlinks only work on the same filesystem as the "
+                    + "vaults, so point this at the shared storage if the vaults live there.")
+    parser_init.add_argument("--layout", choices=LAYOUTS, help="How parse lays out host notes in Content: flat "
+                    + "(default), or one folder per /24 (subnet) or registered domain (domain) with an index note each.")
+    parser_init.add_argument("--aliases", action="store_true", help="Have parse write one note per IP with its "
+                    + "domains as aliases, instead of one note per domain.")
+
+    # Host parse
+    parser_parse = subparsers.add_parser("parse", help="Parse a supplied gnmap or host list into Obsidian notes. Requires an "
+                    + "initialized op folder using the init command.")
+    parser_parse.add_argument("-f", "--folder", help="The full path to the operation folder. Expects that the folder has "
+                    + "been initialized already using the init command.", required=True)
+    parser_parse.add_argument("-n", "--name", required=True, help="REQUIRED - The operation codename.")
+    parser_parse.add_argument("-t", "--type", required=True, help="REQUIRED - The operation type: internal or external",
+                             choices=["internal", "external"], type=str.lower)
+    parser_parse.add_argument("-l", "--host-list", help="Path to the list of hosts, one per line. Hosts that match a "
+                    + "host map entry or the reverse DNS of a scanned host are added to that host's note, the rest get "
+                    + "their own note.")
+    parser_parse.add_argument("-g", "--gnmap", nargs="+", action="extend", help="Path to the gnmap file to parse. "
+                    + "Creates an Obsidian note per entry using the IP address and reverse DNS name if available. "
+                    + "Combine with -m to pair host name with IP. Takes several files, folders of .gnmap files (also "
+                    + ".gnmap.gz/.xz/.bz2) or quoted glob patterns, which are parsed in parallel and merged by IP.")
+    parser_parse.add_argument("-x", "--nmap-xml", help="Path to an nmap XML (-oX) file to parse. Works like -g, but "
+                    + "also adds service versions and NSE script output to the frontmatter. Can be combined with -g, "
+                    + "--masscan and --jsonl, hosts in more than one are merged into one note.")
+    parser_parse.add_argument("--masscan", help="Path to masscan output to parse, list (-oL) or JSON (-oJ). Works like "
+                    + "-g, banners are added as service versions.")
+    parser_parse.add_argument("--jsonl", help="Path to a JSON-lines file of port records to parse, one object per line "
+                    + "with ip and port (and optionally service, version, state) keys, e.g. naabu -json output.")
+    parser_parse.add_argument("--batch-size", type=int, default=PORT_RECORD_BATCH_SIZE, help="Number of masscan/JSON "
+                    + "records grouped by IP before notes are written (default: {0})".format(PORT_RECORD_BATCH_SIZE))
+    parser_parse.add_argument("-m", "--host-map", help="Path to a map file of format: host,ip with each host on a new line. "
+                    + "Used to add host names to file names instead of just IPs when parsing a gnmap file.")
+    parser_parse.add_argument("--incremental", help="Only update notes whose scan data changed since the last parse. "
+                    + "New ports/services are merged into the frontmatter of existing notes and the rest of the note "
+                    + "is left alone.", action="store_true")
+    parser_parse.add_argument("--var", action="append", default=[], metavar="NAME=VALUE", help="Value for text "
+                    + "listed in TEMPLATE_VARIABLES to replace in the host notes. Can be supplied multiple times.")
+    parser_parse.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="Number of threads used to "
+                    + "write notes (default: {0}). Raise this for network mounted vaults.".format(DEFAULT_WORKERS))
+    parser_parse.add_argument("--stats", action="store_true", help="Print per-phase timings and counters as JSON "
+                    + "when finished.")
+    parser_parse.add_argument("--profile", metavar="PATH", help="Write a cProfile/pstats profile of the run to PATH.")
+    parser_parse.add_argument("--resume", action="store_true", help="Continue a parse that was interrupted (crash, "
+                    + "Ctrl-C, full disk) from its last checkpoint. Supply the same arguments as the interrupted run.")
+    parser_parse.add_argument("--layout", choices=LAYOUTS, help="Set the op's note layout: flat, subnet or domain. "
+                    + "Remembered for later runs. Can only be changed before the op has any parsed notes.")
+    parser_parse.add_argument("--scope", metavar="FILE", help="Only write notes for hosts in scope: one CIDR, IP, "
+                    + "range (10.0.0.5-20), host name or wildcard domain (*.client.com) per line. A host is in scope if "
+                    + "its IP or one of its names is.")
+    parser_parse.add_argument("--exclude", metavar="FILE", help="Never write notes for these hosts, same format as "
+                    + "--scope. Excluded names are removed from hosts that are otherwise in scope.")
+    parser_parse.add_argument("--aliases", action="store_true", help="Write one note per IP with its domains as "
+                    + "aliases, instead of one note per domain. Remembered for later runs. Use the collapse command "
+                    + "to switch an op that already has notes.")
+
+
+    # Watch scan output
+    parser_watch = subparsers.add_parser("watch", help="Follow gnmap/xml files (or folders of them) while a scan is "
+                    + "running and create/update host notes as new hosts come in. Requires an initialized op folder.")
+    parser_watch.add_argument("paths", nargs="+", help="gnmap or nmap xml files, or folders containing .gnmap/.xml files")
+    parser_watch.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation folder.")
+    parser_watch.add_argument("-n", "--name", required=True, help="REQUIRED - The operation codename.")
+    parser_watch.add_argument("-t", "--type", required=True, help="REQUIRED - The operation type: internal or external",
+                             choices=["internal", "external"], type=str.lower)
+    parser_watch.add_argument("-l", "--host-list", help="Path to a list of hosts to match against the scanned hosts.")
+    parser_watch.add_argument("-m", "--host-map", help="Path to a host,ip map file used to name the notes.")
+    parser_watch.add_argument("--interval", type=float, default=2.0, help="Seconds between checks for new output "
+                    + "(default: 2). With inotify, changes are picked up sooner.")
+    parser_watch.add_argument("--debounce", type=float, default=5.0, help="Seconds to collect changes before writing "
+                    + "notes, so Obsidian isn't flooded with updates (default: 5)")
+    parser_watch.add_argument("--poll", action="store_true", help="Poll for changes instead of using inotify.")
+    parser_watch.add_argument("--once", action="store_true", help="Apply whatever is new since the last run and exit.")
+    parser_watch.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="Number of threads used to "
+                    + "write notes (default: {0}).".format(DEFAULT_WORKERS))
+
+    # Canvas generation
+    parser_canvas = subparsers.add_parser("canvas", help="Generate Obsidian canvases of the op's host notes, grouped "
+                    + "by subnet or domain, linking related hosts and findings.")
+    parser_canvas.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation folder.")
+    parser_canvas.add_argument("-g", "--group-by", choices=["subnet", "domain"], default="subnet", help="Group hosts "
+                    + "by /24 or registered domain (default: subnet)")
+    parser_canvas.add_argument("--max-nodes", type=int, default=CANVAS_MAX_NODES, help="Most host notes to put on one "
+                    + "canvas before splitting into several (default: {0})".format(CANVAS_MAX_NODES))
+
+    # Collapse per-domain notes
+    parser_collapse = subparsers.add_parser("collapse", help="Merge the op's note per domain for each IP into one note "
+                    + "per IP with the domains as aliases, and switch the op to --aliases. Links to the old notes are "
+                    + "updated.")
+    parser_collapse.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation "
+                    + "folder.")
+
+    # Export
+    parser_export = subparsers.add_parser("export", help="Export the op's host notes and findings as CSV or JSON "
+                    + "lines, e.g. for reporting.")
+    parser_export.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation folder.")
+    parser_export.add_argument("-o", "--output", help="File to write to (default: stdout)")
+    parser_export.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="Output format (default: "
+                    + "csv). List fields are joined with ; in CSV.")
+    parser_export.add_argument("-p", "--processes", type=int, help="Number of processes reading notes (default: one "
+                    + "per core)")
+
+    # Screenshots
+    parser_images = subparsers.add_parser("images", help="Add a folder of screenshots (e.g. from gowitness, aquatone or "
+                    + "EyeWitness) to the op's Images folder and embed them in the matching host notes.")
+    parser_images.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation folder.")
+    parser_images.add_argument("-d", "--directory", required=True, help="REQUIRED - Folder of screenshots, searched "
+                    + "recursively. Screenshots are matched to hosts by the IP or host name in their file name.")
+    parser_images.add_argument("--thumbnail-size", type=int, default=THUMBNAIL_SIZE, help="Longest side of the "
+                    + "embedded thumbnails in pixels (default: {0}). Needs Pillow.".format(THUMBNAIL_SIZE))
+    parser_images.add_argument("-p", "--processes", type=int, help="Number of processes hashing and thumbnailing "
+                    + "screenshots (default: one per core)")
+
+    # Index refresh
+    parser_index = subparsers.add_parser("index", help="Rebuild the op's search index from the notes in Content. Run "
+                    + "this after editing notes in Obsidian so query sees the changes.")
+    parser_index.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation folder.")
+
+    # Index query
+    parser_query = subparsers.add_parser("query", help="Look up host notes by port, service, finding or follow up "
+                    + "using the op's search index. Filters are combined.")
+    parser_query.add_argument("-f", "--folder", required=True, help="REQUIRED - The full path to the operation folder.")
+    parser_query.add_argument("-p", "--port", help="Notes with this open port")
+    parser_query.add_argument("-s", "--service", help="Notes with a service containing this text (case insensitive)")
+    parser_query.add_argument("--finding", action="store_true", help="Notes marked with finding: true")
+    parser_query.add_argument("--follow-up", action="store_true", help="Notes marked with followUp: true")
+    parser_query.add_argument("--refresh", action="store_true", help="Rebuild the index from the notes before querying")
+
+    args = parser.parse_args()
+
+    if args.command in ["init", "parse"]:
+        set_template_values(args.var)
+
+    if args.command == "parse":
         if not is_initialized(args.folder):
             print("Error: The supplied folder does not appear to be initialized. Please run init first.")
             sys.exit(1)
         
-        if args.host_list is None and args.gnmap is None and args.host_map is None:
-            print("Error: Please supply at least one of: -l/--host-list, -g/--gnmap, -m/--host-map to continue.")
+        inputs = [args.host_list, args.gnmap, args.nmap_xml, args.masscan, args.jsonl, args.host_map]
+        if all(path is None for path in inputs):
+            print("Error: Please supply at least one of: -l/--host-list, -g/--gnmap, -x/--nmap-xml, --masscan, --jsonl, "
+                + "-m/--host-map to continue.")
             sys.exit(1)
 
-        if args.host_list and args.host_map:
-            print("[*] You supplied both a host list and host map, defaulting to host map for file creation.\n")
-            args.host_list = None
-
-        if args.host_list and args.gnmap:
-            print("\n[!] You have supplied both a host list and a gnmap file. I can (A) create files for both, which "
-                + "may result in duplicate host files; (B) only use the gnmap (and map file, if supplied); or (C) "
-                + "terminate and you combine the host and IP list into a file with format host,ip on new lines "
-                + "before running again with -g and -m. Which would you like to do? ", end="(a/b/C): ")
-            user_input = input()
-            match user_input.lower():
-                case "b":
-                    args.host_list = None
-                case "c":
-                    print("Exiting.")
-                    sys.exit(1)
-                case _:
-                    pass
-
-        handle_parse(args.folder, args.name, args.type, args.host_list, args.gnmap, args.host_map)
+        try:
+            run_command(handle_parse, [args.folder, args.name, args.type, args.host_list, args.gnmap, args.host_map,
+                        args.incremental, args.workers, args.nmap_xml, args.masscan, args.jsonl,
+                        max(args.batch_size, 1), args.layout, args.resume, args.aliases, args.scope,
+                        args.exclude], args.stats, args.profile)
+        except KeyboardInterrupt:
+            print("\n[!] Parse interrupted. Run the same command with --resume to continue where it left off.")
+            sys.exit(1)
         print('[+] If you already have this vault open, the DataView tables might not work until you '
             + 're-open the vault.')
 
+    if args.command == "watch":
+        if not is_initialized(args.folder):
+            print("Error: The supplied folder does not appear to be initialized. Please run init first.")
+            sys.exit(1)
+
+        for path in args.paths + [args.host_list, args.host_map]:
+            if path is not None and not validate_path(path):
+                print("Error: The supplied path could not be found: {0}".format(path))
+                sys.exit(1)
+
+        handle_watch(args.folder, args.name, args.type, args.paths, args.host_list, args.host_map, args.interval,
+                     args.debounce, args.poll, args.once, args.workers)
+
+    if args.command in ["index", "query", "canvas", "collapse", "export", "images"]:
+        if not is_initialized(args.folder):
+            print("Error: The supplied folder does not appear to be initialized. Please run init first.")
+            sys.exit(1)
+
+    if args.command == "index":
+        handle_index(args.folder)
+
+    if args.command == "collapse":
+        handle_collapse(args.folder)
+
+    if args.command == "images":
+        if not validate_path(args.directory):
+            print("Error: The supplied screenshot folder could not be found: {0}".format(args.directory))
+            sys.exit(1)
+        handle_images(args.folder, args.directory, max(args.thumbnail_size, 1), args.processes)
+
+    if args.command == "export":
+        handle_export(args.folder, args.output, args.format, max(args.processes or os.cpu_count() or 1, 1))
+
+    if args.command == "canvas":
+        handle_canvas(args.folder, args.group_by, args.max_nodes)
+
+    if args.command == "query":
+        if args.refresh:
+            handle_index(args.folder)
+        handle_query(args.folder, args.port, args.service, args.finding, args.follow_up)
+
     if args.command == "init":
+        set_asset_options(args.link, args.asset_store)
+
+        if args.batch is None and (args.name is None or args.type is None):
+            print("Error: Please supply -n/--name and -t/--type, or --batch.")
+            sys.exit(1)
+        if args.batch is not None and not validate_path(args.batch):
+            print("Error: The supplied batch file could not be found: {0}".format(args.batch))
+            sys.exit(1)
+
         # Validate the path
-        if validate_path(args.folder):
-            handle_init(args.folder, args.name, args.type, args.vault, args.reusable, args.template)
-        else:
+        if not validate_path(args.folder):
             print("The designated path does not exist. Please supply an existing folder in which to create the vault / op folder.\n\n"
                   + "Example: /home/users/demoUser/ for a vault or /home/users/demoUser/AssessmentNotes for a single op folder")
             sys.exit(1)
+        elif args.batch is not None:
+            run_command(handle_batch_init, [args.folder, args.batch, args.vault, args.reusable, args.template,
+                        args.layout, args.aliases], args.stats, args.profile)
+        else:
+            run_command(handle_init, [args.folder, args.name, args.type, args.vault, args.reusable, args.template,
+                        args.layout, True, args.aliases], args.stats, args.profile)
 
         print("\n[+] Your repo is ready. If you already have it open, it should refresh. If it's new, Go to Obsidian > "
             + "Manage Vaults > Open Folder as Vault.\n\n")